@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  accel.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import numpy as np
+from math import inf, floor
+from hashlib import sha256
+
+# Margen agregado a las cajas, para que impactos sobre el borde de una
+# caja (p.ej. triángulos paralelos a un eje) no se pierdan por redondeo
+BOX_PADDING = 1e-7
+
+# Grid: primitivas por celda (en promedio) y celdas máximas por eje
+GRID_DENSITY = 2
+GRID_MAX_RES = 128
+
+# Selección automática (make_accel): Grid si hay al menos GRID_MIN_OBJECTS
+# primitivas y el tamaño del percentil 95 no supera GRID_MAX_SPREAD veces
+# la mediana (objetos de tamaño parecido)
+GRID_MIN_OBJECTS = 256
+GRID_MAX_SPREAD = 3
+
+ACCEL_KINDS = ("auto", "bvh", "grid")
+
+# Cache de estructuras (ver use_cache). Con menos primitivas que
+# ACCEL_CACHE_MIN es más rápido construirlas que buscarlas en el cache.
+# Cambiar ACCEL_CACHE_VERSION si cambia la construcción o el formato.
+ACCEL_CACHE_MIN = 2000
+ACCEL_CACHE_VERSION = 1
+accel_cache = None
+
+
+"""
+ ______     ___   _
+| __ ) \   / / | | |
+|  _ \\ \ / /| |_| |
+| |_) |\ V / |  _  |
+|____/  \_/  |_| |_|
+
+"""
+
+class BVH:
+    """ Jerarquía de volúmenes envolventes (cajas alineadas a los ejes).
+        La estructura no conoce las primitivas: solo sus cajas. Las
+        consultas reciben una función que intersecta una lista de índices
+        de primitivas (ver nearest).
+        Los nodos quedan en arrays de NumPy (ver build), que se pueden
+        guardar y mapear de un archivo sin convertirlos (ver from_arrays).
+    """
+    def __init__(self, lo, hi, leaf_size = 4):
+        """ lo, hi      (N, 3) Esquinas mínima y máxima de cada primitiva
+            leaf_size   Cantidad máxima de primitivas por hoja
+        """
+        lo = np.asarray(lo, dtype = float).reshape(-1, 3) - BOX_PADDING
+        hi = np.asarray(hi, dtype = float).reshape(-1, 3) + BOX_PADDING
+        self.leaf_size = leaf_size
+        self.build(lo, hi)
+
+
+    def build(self, lo, hi):
+        """ Construye los nodos dividiendo por la mediana de los centros,
+            sobre el eje más largo. Cada nodo es una fila de
+                boxes   (K, 6) float64: lox, loy, loz, hix, hiy, hiz
+                links   (K, 5) int64: axis, left, right, start, end
+            left/right son los hijos (-1 en las hojas), start:end el rango
+            de primitivas (en self.order) de las hojas. El nodo 0 es la
+            raíz.
+        """
+        centers = (lo + hi) / 2
+        order = np.arange(len(lo))
+        boxes, links = [], []
+
+        stack = [(0, len(lo), None, None)] if len(lo) else []
+        while stack:                    # start, end, padre, lado
+            start, end, parent, side = stack.pop()
+            idx = order[start:end]
+            node = len(links)
+            if parent is not None:
+                links[parent][side] = node
+
+            boxes.append((*lo[idx].min(axis = 0).tolist(),
+                          *hi[idx].max(axis = 0).tolist()))
+            count = end - start
+            if count <= self.leaf_size:
+                links.append([0, -1, -1, start, end])
+                continue
+
+            c = centers[idx]
+            axis = int(np.argmax(c.max(axis = 0) - c.min(axis = 0)))
+            mid = count // 2
+            part = np.argpartition(c[:, axis], mid)
+            order[start:end] = idx[part]
+
+            links.append([axis, -1, -1, start, end])
+            stack.append((start + mid, end, node, 2))
+            stack.append((start, start + mid, node, 1))
+
+        self.boxes = np.array(boxes, dtype = np.float64).reshape(-1, 6)
+        self.links = np.array(links, dtype = np.int64).reshape(-1, 5)
+        self.order = order
+
+
+    def to_arrays(self):
+        """ La estructura como arrays planos (para guardarla, ver
+            make_accel)
+        """
+        return {"boxes": self.boxes, "links": self.links,
+                "order": np.asarray(self.order, dtype = np.int64)}
+
+
+    @classmethod
+    def from_arrays(cls, arrays, order = None):
+        """ Estructura sobre los arrays de to_arrays, sin copiarlos (p.ej.
+            mapeados de un archivo con geometry.read_geometry). Falla con
+            KeyError, ValueError o IndexError si los arrays no son de un
+            BVH válido.
+            order       Reemplaza a arrays["order"] (p.ej. range(n), para
+                        primitivas ya ordenadas con sort_primitives)
+        """
+        bvh = cls.__new__(cls)
+        bvh.boxes = np.asarray(arrays["boxes"], dtype = np.float64).reshape(-1, 6)
+        bvh.links = np.asarray(arrays["links"], dtype = np.int64).reshape(-1, 5)
+        bvh.order = arrays["order"].reshape(-1) if order is None else order
+        links = bvh.links
+        if len(links) != len(bvh.boxes) or len(links) and (
+                        links[:, 1:3].max() >= len(links) or
+                        links[:, 3:].min() < 0 or
+                        links[:, 4].max() > len(bvh.order)):
+            raise ValueError("BVH: nodos inconsistentes")
+        bvh.leaf_size = None
+        return bvh
+
+
+    def sort_primitives(self):
+        """ Para quien guarda sus primitivas en arrays: devuelve el orden
+            de las primitivas en las hojas (un array de índices), con el
+            que el llamador debe reordenar sus arrays. Desde entonces las
+            consultas reciben range(start, end), y cada hoja es una
+            rebanada contigua (sin copias) de esos arrays.
+        """
+        perm = np.asarray(self.order, dtype = np.intp)
+        self.order = range(len(perm))
+        return perm
+
+
+    def views(self):
+        """ boxes y links como memoryview planos: leer un elemento de un
+            memoryview es mucho más rápido que de un array de NumPy, y no
+            hace falta convertir los nodos a listas
+        """
+        return (memoryview(np.ascontiguousarray(self.boxes)).cast("B").cast("d"),
+                memoryview(np.ascontiguousarray(self.links)).cast("B").cast("q"))
+
+
+    def nearest(self, ray, intersect, tmin = 0, tmax = inf):
+        """ Busca el impacto más cercano con tmin < t < tmax.
+            intersect(indices, ray, tmin, tmax) debe devolver (t, hit) del
+            impacto más cercano entre las primitivas indicadas, o None.
+            Devuelve (t, hit) o None.
+        """
+        if len(self.links) == 0:
+            return None
+
+        ox, oy, oz = ray.loc.x, ray.loc.y, ray.loc.z
+        dx, dy, dz = ray.dir.x, ray.dir.y, ray.dir.z
+        ix = 1/dx if dx else 1e300
+        iy = 1/dy if dy else 1e300
+        iz = 1/dz if dz else 1e300
+        positive = (dx >= 0, dy >= 0, dz >= 0)
+
+        boxes, links = self.views()
+        order = self.order
+        best = None
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            b = node * 6
+            # Prueba de 'slabs' contra la caja del nodo
+            t0 = (boxes[b] - ox) * ix; t1 = (boxes[b + 3] - ox) * ix
+            if t0 > t1: t0, t1 = t1, t0
+            near, far = max(tmin, t0), min(tmax, t1)
+            t0 = (boxes[b + 1] - oy) * iy; t1 = (boxes[b + 4] - oy) * iy
+            if t0 > t1: t0, t1 = t1, t0
+            near, far = max(near, t0), min(far, t1)
+            t0 = (boxes[b + 2] - oz) * iz; t1 = (boxes[b + 5] - oz) * iz
+            if t0 > t1: t0, t1 = t1, t0
+            near, far = max(near, t0), min(far, t1)
+            if near > far:
+                continue
+
+            axis, left, right, start, end = links[node * 5:node * 5 + 5].tolist()
+            if left < 0:
+                found = intersect(order[start:end], ray, tmin, tmax)
+                if found is not None:
+                    tmax, best = found[0], found
+            elif positive[axis]:        # Visitar primero el hijo más cercano
+                stack.append(right)
+                stack.append(left)
+            else:
+                stack.append(left)
+                stack.append(right)
+
+        return best
+
+
+    def any_hit(self, ray, occludes, tmin = 0, tmax = inf):
+        """ Indica si alguna primitiva corta al rayo con tmin < t < tmax.
+            occludes(indices, ray, tmin, tmax) debe devolver True si alguna
+            de las primitivas indicadas lo hace. Termina en el primer
+            impacto encontrado.
+        """
+        if len(self.links) == 0:
+            return False
+
+        ox, oy, oz = ray.loc.x, ray.loc.y, ray.loc.z
+        dx, dy, dz = ray.dir.x, ray.dir.y, ray.dir.z
+        ix = 1/dx if dx else 1e300
+        iy = 1/dy if dy else 1e300
+        iz = 1/dz if dz else 1e300
+
+        boxes, links = self.views()
+        order = self.order
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            b = node * 6
+            t0 = (boxes[b] - ox) * ix; t1 = (boxes[b + 3] - ox) * ix
+            if t0 > t1: t0, t1 = t1, t0
+            near, far = max(tmin, t0), min(tmax, t1)
+            t0 = (boxes[b + 1] - oy) * iy; t1 = (boxes[b + 4] - oy) * iy
+            if t0 > t1: t0, t1 = t1, t0
+            near, far = max(near, t0), min(far, t1)
+            t0 = (boxes[b + 2] - oz) * iz; t1 = (boxes[b + 5] - oz) * iz
+            if t0 > t1: t0, t1 = t1, t0
+            near, far = max(near, t0), min(far, t1)
+            if near > far:
+                continue
+
+            axis, left, right, start, end = links[node * 5:node * 5 + 5].tolist()
+            if left < 0:
+                if occludes(order[start:end], ray, tmin, tmax):
+                    return True
+            else:
+                stack.append(right)
+                stack.append(left)
+
+        return False
+
+
+
+"""
+  ____      _     _
+ / ___|_ __(_) __| |
+| |  _| '__| |/ _` |
+| |_| | |  | | (_| |
+ \____|_|  |_|\__,_|
+
+"""
+
+class Grid:
+    """ Grilla uniforme de celdas, recorrida con 3D-DDA (Amanatides &
+        Woo). Más barata de construir que el BVH, y buena para muchas
+        primitivas de tamaño parecido. Mismas consultas que BVH (nearest,
+        any_hit): las funciones reciben la lista de primitivas de cada
+        celda (una primitiva puede estar en varias celdas).
+    """
+    def __init__(self, lo, hi, density = GRID_DENSITY):
+        """ lo, hi      (N, 3) Esquinas mínima y máxima de cada primitiva
+            density     Primitivas por celda, en promedio
+        """
+        lo = np.asarray(lo, dtype = float).reshape(-1, 3) - BOX_PADDING
+        hi = np.asarray(hi, dtype = float).reshape(-1, 3) + BOX_PADDING
+        self.density = density
+        self.build(lo, hi)
+
+
+    def build(self, lo, hi):
+        """ Asigna cada primitiva a las celdas que toca su caja. Las
+            primitivas de la celda c son items[start[c]:start[c + 1]].
+        """
+        n = len(lo)
+        if n == 0:
+            self.start = np.zeros(0, dtype = np.int64)
+            self.items = np.zeros(0, dtype = np.int64)
+            return
+
+        self.lo = glo = lo.min(axis = 0)
+        ghi = hi.max(axis = 0)
+        extent = np.maximum(ghi - glo, BOX_PADDING)
+        # Celdas aproximadamente cúbicas, density primitivas por celda
+        side = (np.prod(extent) * self.density / n) ** (1/3)
+        res = np.clip(np.ceil(extent / side), 1, GRID_MAX_RES).astype(int)
+        self.res = tuple(res.tolist())
+        self.cell = extent / res
+        self.hi = glo + self.cell * res
+
+        c0 = np.clip(((lo - glo) / self.cell).astype(int), 0, res - 1)
+        c1 = np.clip(((hi - glo) / self.cell).astype(int), 0, res - 1)
+        span = c1 - c0 + 1
+        counts = np.prod(span, axis = 1)
+
+        # Una entrada (celda, primitiva) por cada celda de cada caja
+        obj = np.repeat(np.arange(n), counts)
+        local = np.arange(len(obj)) - np.repeat(np.cumsum(counts) - counts, counts)
+        sx, sy = span[obj, 0], span[obj, 1]
+        x = c0[obj, 0] + local % sx
+        y = c0[obj, 1] + (local // sx) % sy
+        z = c0[obj, 2] + local // (sx * sy)
+        cells = (z * res[1] + y) * res[0] + x
+
+        order = np.argsort(cells, kind = "stable")
+        self.items = obj[order].astype(np.int64)
+        self.start = np.searchsorted(cells[order],
+                                     np.arange(np.prod(res) + 1)).astype(np.int64)
+
+
+    def to_arrays(self):
+        """ Ver BVH.to_arrays
+        """
+        return {"start": self.start, "items": self.items,
+                "box": np.array((self.lo, self.hi, self.cell), dtype = float),
+                "res": np.array([self.res], dtype = np.int64)}
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ Ver BVH.from_arrays
+        """
+        grid = cls.__new__(cls)
+        grid.start = np.asarray(arrays["start"], dtype = np.int64).reshape(-1)
+        grid.items = arrays["items"].reshape(-1)
+        grid.lo, grid.hi, grid.cell = np.array(arrays["box"])
+        grid.res = tuple(arrays["res"][0].tolist())
+        if len(grid.start) != np.prod(grid.res) + 1 or \
+                        grid.start[-1] != len(grid.items):
+            raise ValueError("Grid: celdas inconsistentes")
+        grid.density = None
+        return grid
+
+
+    def starts(self):
+        """ start como memoryview (ver BVH.views)
+        """
+        return memoryview(np.ascontiguousarray(self.start)).cast("B").cast("q")
+
+
+    def cells(self, ray, tmin, tmax):
+        """ Recorre las celdas que atraviesa el rayo entre tmin y tmax, en
+            orden. Produce (celda, t de salida de la celda).
+        """
+        if len(self.items) == 0:
+            return
+
+        o = (ray.loc.x, ray.loc.y, ray.loc.z)
+        d = (ray.dir.x, ray.dir.y, ray.dir.z)
+
+        # Entrada y salida de la caja de la grilla
+        near, far = tmin, tmax
+        for k in range(3):
+            if d[k]:
+                t0 = (self.lo[k] - o[k]) / d[k]
+                t1 = (self.hi[k] - o[k]) / d[k]
+                if t0 > t1: t0, t1 = t1, t0
+                near, far = max(near, t0), min(far, t1)
+            elif not self.lo[k] <= o[k] <= self.hi[k]:
+                return
+        if near > far:
+            return
+
+        idx, step, tnext, tdelta = [], [], [], []
+        for k in range(3):
+            i = floor((o[k] + d[k] * near - self.lo[k]) / self.cell[k])
+            i = min(max(i, 0), self.res[k] - 1)
+            idx.append(i)
+            if d[k] > 0:
+                step.append(1)
+                tnext.append((self.lo[k] + (i + 1) * self.cell[k] - o[k]) / d[k])
+                tdelta.append(self.cell[k] / d[k])
+            elif d[k] < 0:
+                step.append(-1)
+                tnext.append((self.lo[k] + i * self.cell[k] - o[k]) / d[k])
+                tdelta.append(-self.cell[k] / d[k])
+            else:
+                step.append(0)
+                tnext.append(inf)
+                tdelta.append(inf)
+
+        ix, iy, iz = idx
+        rx, ry, rz = self.res
+        sx, sy, sz = step
+        tx, ty, tz = tnext
+        dx, dy, dz = tdelta
+        while True:
+            texit = min(tx, ty, tz)
+            yield (iz * ry + iy) * rx + ix, texit
+            if texit > far:
+                return
+            if tx == texit:
+                ix += sx; tx += dx
+                if not 0 <= ix < rx: return
+            elif ty == texit:
+                iy += sy; ty += dy
+                if not 0 <= iy < ry: return
+            else:
+                iz += sz; tz += dz
+                if not 0 <= iz < rz: return
+
+
+    def nearest(self, ray, intersect, tmin = 0, tmax = inf):
+        """ Ver BVH.nearest
+        """
+        start, items = self.starts(), self.items
+        best = None
+        for cell, texit in self.cells(ray, tmin, tmax):
+            a, b = start[cell], start[cell + 1]
+            if a < b:
+                found = intersect(items[a:b], ray, tmin, tmax)
+                if found is not None:
+                    tmax, best = found[0], found
+            # Un impacto antes de la salida de la celda es el más cercano
+            if best is not None and tmax <= texit:
+                break
+
+        return best
+
+
+    def any_hit(self, ray, occludes, tmin = 0, tmax = inf):
+        """ Ver BVH.any_hit
+        """
+        start, items = self.starts(), self.items
+        for cell, texit in self.cells(ray, tmin, tmax):
+            a, b = start[cell], start[cell + 1]
+            if a < b and occludes(items[a:b], ray, tmin, tmax):
+                return True
+
+        return False
+
+
+
+def choose_accel(lo, hi):
+    """ Elige "grid" o "bvh" según la cantidad y la dispersión de los
+        tamaños de las cajas
+    """
+    if len(lo) < GRID_MIN_OBJECTS:
+        return "bvh"
+    size = np.linalg.norm(np.asarray(hi, dtype = float) -
+                          np.asarray(lo, dtype = float), axis = 1)
+    median = np.median(size)
+    if median <= 0 or np.percentile(size, 95) > GRID_MAX_SPREAD * median:
+        return "bvh"
+    return "grid"
+
+
+def use_cache(cache):
+    """ Guarda las estructuras construidas por make_accel en cache (p.ej.
+        cache.AccelCache: un objeto con load(key), que devuelve los arrays
+        o None, save(key, arrays) y discard(key)), o deja de hacerlo
+        (cache = None). Cada proceso tiene su propio cache (ver
+        parallel.init_worker).
+    """
+    global accel_cache
+    accel_cache = cache
+
+
+def accel_key(kind, size, lo, hi):
+    """ Clave de una estructura: tipo, parámetro y cajas de las primitivas
+    """
+    h = sha256("{}:{}:{}:".format(ACCEL_CACHE_VERSION, kind, size).encode())
+    h.update(np.ascontiguousarray(lo, dtype = float).tobytes())
+    h.update(np.ascontiguousarray(hi, dtype = float).tobytes())
+    return h.hexdigest()
+
+
+def cache_load(key, convert):
+    """ Lee la entrada key del cache (ver use_cache) y devuelve
+        convert(arrays), o None si no hay cache o la entrada no está. Si
+        convert falla (KeyError, ValueError, IndexError: entrada dañada o
+        de otro tipo), se descarta la entrada.
+    """
+    if accel_cache is None:
+        return None
+    arrays = accel_cache.load(key)
+    if arrays is None:
+        return None
+    try:
+        return convert(arrays)
+    except (KeyError, ValueError, IndexError):
+        accel_cache.discard(key)
+        return None
+
+
+def cache_save(key, arrays):
+    """ Guarda arrays en el cache bajo key. Devuelve False si no hay cache
+    """
+    if accel_cache is None:
+        return False
+    accel_cache.save(key, arrays)
+    return True
+
+
+def make_accel(lo, hi, kind = "auto", leaf_size = 4, density = GRID_DENSITY):
+    """ Construye la estructura indicada (ACCEL_KINDS) sobre las cajas
+        lo, hi. Con "auto", la elige choose_accel. Si hay un cache (ver
+        use_cache), se lee de él en lugar de construirla.
+        leaf_size, density  Primitivas por hoja (BVH) y por celda (Grid):
+                    conviene que sean más grandes si cada llamada a las
+                    funciones de intersección es cara (p.ej. NumPy)
+        Las consultas reciben los índices de las primitivas como
+        rebanadas de un array de NumPy.
+    """
+    if kind == "auto":
+        kind = choose_accel(lo, hi)
+    if kind not in ("bvh", "grid"):
+        raise ValueError("Estructura de aceleración desconocida: {}".format(kind))
+    cls, size = (BVH, leaf_size) if kind == "bvh" else (Grid, density)
+
+    if accel_cache is None or len(lo) < ACCEL_CACHE_MIN:
+        return cls(lo, hi, size)
+
+    key = accel_key(kind, size, lo, hi)
+    accel = cache_load(key, cls.from_arrays)
+    if accel is None:
+        accel = cls(lo, hi, size)
+        if cache_save(key, accel.to_arrays()):
+            # Mapeada del archivo: no queda una copia en memoria
+            accel = cache_load(key, cls.from_arrays) or accel
+    return accel
+
+
+
+def test_bvh():
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, (1000, 3))
+    bvh = BVH(centers - 0.1, centers + 0.1)
+    print("{} nodos, {} primitivas".format(len(bvh.links), len(bvh.order)))
+    print(bvh.boxes[0], bvh.links[0])
+
+
+def test_grid(n = 1000):
+    """ Compara Grid con la búsqueda exhaustiva, en esferas al azar
+    """
+    from rtmath import Ray, new_vec3
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, (n, 3))
+    radius = 0.5
+    grid = Grid(centers - radius, centers + radius)
+    print("Grilla {}, {} entradas".format(grid.res, len(grid.items)))
+
+    def hits(indices, ray):
+        o = np.array(ray.loc.to_tuple()); d = np.array(ray.dir.to_tuple())
+        for i in indices:
+            oc = o - centers[i]
+            b = oc @ d
+            disc = b*b - oc @ oc + radius**2
+            if disc >= 0 and -b - np.sqrt(disc) > 0:
+                yield -b - np.sqrt(disc), i
+
+    def intersect(indices, ray, tmin, tmax):
+        found = [(t, i) for t, i in hits(indices, ray) if tmin < t < tmax]
+        return min(found) if found else None
+
+    errors = 0
+    for _ in range(200):
+        d = rng.normal(size = 3)
+        ray = Ray(new_vec3(0.0, 0.0, -15.0), new_vec3(*(d / np.linalg.norm(d))))
+        if grid.nearest(ray, intersect) != intersect(range(n), ray, 0, inf):
+            errors += 1
+    print("Diferencias con la búsqueda exhaustiva:", errors)
+
+
+def main(args):
+    test_bvh()
+    # ~ test_grid()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  bench.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Benchmarks con escenas de referencia. Mide por separado parseo,
+    clasificación, compilación a arrays (solo con --wavefront),
+    construcción del BVH, rayos primarios, rayos de sombra y salida de
+    la imagen, y guarda los resultados en JSON para comparar corridas:
+
+        python3 bench.py -s 320x240 -o antes.json
+        python3 bench.py demo1 spheres-5000 -o despues.json
+        python3 bench.py particles-100000 --accel bvh,grid
+        python3 bench.py spheres-5000 --wavefront
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
+from math import sqrt
+
+import numpy as np
+
+from parse import Pov_parser
+from scene import Scene
+from render import DEFAULT_AMBIENT
+from wavefront import WavefrontTracer
+
+DEFAULT_SCENES = ("demo1", "spheres-100", "spheres-1000",
+                  "triangles-1000", "mixed-4000")
+
+SCENE_HEADER = """
+camera { location <0, 0, -1> look_at <0, 0, 1> angle 30 }
+light_source { <2, 5, 2>, rgb <1, 1, 1> }
+light_source { <-3, 2, -1>, rgb <0.4, 0.4, 0.6> }
+"""
+
+# Directorio de los arrays de las escenas 'particles-N'
+PARTICLE_DIR = os.path.join(tempfile.gettempdir(), "rt-bench")
+
+
+def sphere_scene(nr, seed = 1):
+    """ nr esferas de tamaño similar, en un volumen delante de la cámara
+    """
+    rng = np.random.default_rng(seed)
+    r = 0.6 / nr**(1/3)
+    lines = [SCENE_HEADER]
+    for (x, y, z), (cr, cg, cb) in zip(rng.uniform((-1.8, -1.4, 4), (1.8, 1.4, 8), (nr, 3)),
+                                       rng.uniform(0.2, 1, (nr, 3))):
+        lines.append("sphere {{ <{:.4f}, {:.4f}, {:.4f}>, {:.4f} "
+                     "texture {{ pigment {{ rgb <{:.2f}, {:.2f}, {:.2f}> }} }} }}".format(
+                            x, y, z, r, cr, cg, cb))
+    return "\n".join(lines)
+
+
+def triangle_scene(nr, seed = 2):
+    """ nr triángulos pequeños, orientados al azar
+    """
+    rng = np.random.default_rng(seed)
+    size = 1.2 / nr**(1/3)
+    lines = [SCENE_HEADER]
+    for center in rng.uniform((-1.8, -1.4, 4), (1.8, 1.4, 8), (nr, 3)):
+        verts = center + rng.normal(scale = size, size = (3, 3))
+        lines.append("triangle {{ {} texture {{ pigment {{ rgb <0, 1, 1> }} }} }}".format(
+                        ", ".join("<{:.4f}, {:.4f}, {:.4f}>".format(*v) for v in verts)))
+    return "\n".join(lines)
+
+
+def mesh_scene(nr):
+    """ Esfera teselada como un mesh2 de (aproximadamente) nr triángulos
+    """
+    rings = max(2, int(round(sqrt(nr / 2))))
+    theta = np.linspace(0, np.pi, rings + 1)
+    phi = np.linspace(0, 2 * np.pi, 2 * rings, endpoint = False)
+    th, ph = np.meshgrid(theta, phi, indexing = "ij")
+    verts = np.column_stack((np.sin(th).ravel() * np.cos(ph).ravel(),
+                             np.cos(th).ravel(),
+                             np.sin(th).ravel() * np.sin(ph).ravel())) * 1.5
+    verts += (0, 0, 6)
+
+    faces = []
+    nphi = len(phi)
+    for i in range(rings):
+        for j in range(nphi):
+            a, b = i * nphi + j, i * nphi + (j + 1) % nphi
+            faces += [(a, a + nphi, b), (b, a + nphi, b + nphi)]
+
+    return (SCENE_HEADER +
+            "mesh2 {{\n  vertex_vectors {{ {}, {} }}\n"
+            "  face_indices {{ {}, {} }}\n"
+            "  texture {{ pigment {{ rgb <1, 0.8, 0.2> }} }}\n}}\n".format(
+                len(verts), ", ".join("<{:.5f}, {:.5f}, {:.5f}>".format(*v) for v in verts),
+                len(faces), ", ".join("<{}, {}, {}>".format(*f) for f in faces)))
+
+
+def particle_scene(nr, seed = 1, accel = "auto"):
+    """ Como sphere_scene, pero como un sphere_set: los arrays se guardan
+        en PARTICLE_DIR. accel: estructura interna del sphere_set.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform((-1.8, -1.4, 4), (1.8, 1.4, 8), (nr, 3))
+    colors = rng.uniform(0.2, 1, (nr, 3))
+    radii = np.full(nr, 0.6 / nr**(1/3))
+
+    os.makedirs(PARTICLE_DIR, exist_ok = True)
+    files = {}
+    for key, arr in (("centers", centers), ("radii", radii), ("colors", colors)):
+        files[key] = os.path.join(PARTICLE_DIR, "particles-{}-{}.npy".format(nr, key))
+        np.save(files[key], arr)
+
+    return SCENE_HEADER + 'sphere_set {{ centers "{centers}" radii "{radii}" ' \
+                          'colors "{colors}" accel {accel} }}\n'.format(
+                                accel = accel, **files)
+
+
+def mixed_scene(nr):
+    return (sphere_scene(nr // 2) + "\n" +
+            triangle_scene(nr - nr // 2).replace(SCENE_HEADER, ""))
+
+
+def scene_text(name, accel = "auto"):
+    """ Texto de la escena de referencia name: 'demo1' (demo1.rt), o
+        'spheres-N', 'triangles-N', 'mixed-N', 'mesh-N', 'particles-N'
+        (generadas)
+    """
+    if name == "demo1":
+        with open("demo1.rt") as infile:
+            return infile.read()
+
+    kind, nr = name.rsplit("-", 1)
+    if kind == "particles":
+        return particle_scene(int(nr), accel = accel)
+    generator = {"spheres": sphere_scene,
+                 "triangles": triangle_scene,
+                 "mixed": mixed_scene,
+                 "mesh": mesh_scene}[kind]
+    return generator(int(nr))
+
+
+def bench_scene(name, width, height, ambient = DEFAULT_AMBIENT, accel = "auto",
+                wavefront = False):
+    """ Ejecuta una escena etapa por etapa, con la estructura de
+        aceleración accel (ver accel.make_accel), o con el render por
+        etapas (wavefront, ver wavefront.py). Devuelve un diccionario con
+        los tiempos (s) de cada etapa y las cantidades de rayos.
+        Con wavefront el sombreado se mide aparte (etapa shade); en el
+        render normal se hace junto con los rayos de sombra, en shadow.
+    """
+    text = scene_text(name, accel)
+    stages = {}
+
+    t0 = time.perf_counter()
+    parsed = Pov_parser().make_parser().parseString(text).asList()
+    t1 = time.perf_counter()
+    scene = Scene()
+    scene.accel_kind = accel
+    scene.classify(parsed)
+    t2 = time.perf_counter()
+    if wavefront:                       # Solo WavefrontTracer usa los buffers
+        scene.compile()
+    t3 = time.perf_counter()
+    if not wavefront:                   # WavefrontTracer no usa el BVH
+        scene.build_accel()
+    t4 = time.perf_counter()
+    stages["parse"], stages["classify"] = t1 - t0, t2 - t1
+    stages["compile"], stages["accel"] = t3 - t2, t4 - t3
+
+    scene.cam = cam = scene.els["cameras"][0]
+    if wavefront:
+        # Las etapas de WavefrontTracer.render, como en el render normal
+        times = {}
+        tracer = WavefrontTracer(scene)
+        cam.fb = tracer.render(width, height, ambient, partial(timed, times))
+        stages["primary"] = times["primary"]
+        stages["shade"] = times["shade"]
+        stages["shadow"] = times["shadow"]
+        nr_hits = tracer.hits
+    else:
+        # Rayos primarios
+        hits = []
+        t0 = time.perf_counter()
+        for ray, x0, y0 in cam.ray_generator(width, height):
+            hit = scene.find_nearest_thing_hit(ray)
+            if hit is not None:
+                hits.append((ray, hit, x0, y0))
+        stages["primary"] = time.perf_counter() - t0
+
+        # Rayos de sombra y sombreado (Scene.shade)
+        t0 = time.perf_counter()
+        for ray, hit, x0, y0 in hits:
+            cam.set_pixel(x0, height - y0 - 1, scene.shade(ray, hit, ambient))
+        stages["shadow"] = time.perf_counter() - t0
+        nr_hits = len(hits)
+    shadow_rays = nr_hits * len(scene.els["lights"])
+
+    # Salida de la imagen (cuantización y PNG)
+    t0 = time.perf_counter()
+    cam.image.save(io.BytesIO(), "PNG")
+    # Con wavefront, más la escritura en el framebuffer
+    stages["output"] = time.perf_counter() - t0 + (times["output"] if wavefront else 0)
+
+    primary_rays = width * height
+    return {"scene": name,
+            "accel": accel,
+            "wavefront": wavefront,
+            "objects": len(scene.els["objects"]),
+            "width": width, "height": height,
+            "stages": stages,
+            "total": sum(stages.values()),
+            "primary_rays": primary_rays,
+            "shadow_rays": shadow_rays,
+            "hits": nr_hits,
+            "primary_rays_per_s": primary_rays / stages["primary"],
+            "shadow_rays_per_s": shadow_rays / stages["shadow"] if shadow_rays else None,
+            "rays_per_s": (primary_rays + shadow_rays) /
+                                (stages["primary"] + stages.get("shade", 0) +
+                                 stages["shadow"])}
+
+
+@contextmanager
+def timed(times, name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        times[name] = times.get(name, 0) + time.perf_counter() - t0
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output = True, text = True,
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(res):
+    st = res["stages"]
+    mode = "wave" if res["wavefront"] else res["accel"]
+    # Sin wavefront, el sombreado está incluido en shadow
+    shade = "{:6.2f}".format(st["shade"]) if "shade" in st else "     -"
+    print("{:16s} {:5s} {:7d} obj  parse {:6.2f}  classify {:6.2f}  "
+          "compile {:5.2f}  accel {:6.2f}  primary {:6.2f}  shade {}  "
+          "shadow {:6.2f}  output {:5.2f}  total {:6.2f} s  {:8.0f} rayos/s".format(
+                res["scene"], mode, res["objects"], st["parse"], st["classify"],
+                st["compile"], st["accel"], st["primary"], shade, st["shadow"],
+                st["output"], res["total"], res["rays_per_s"]))
+
+
+def main(args):
+    argp = argparse.ArgumentParser(
+                description = "Benchmark del ray tracer con escenas de referencia")
+    argp.add_argument("scenes", nargs = "*", default = DEFAULT_SCENES,
+                help = "Escenas: demo1, spheres-N, triangles-N, mixed-N, mesh-N, "
+                       "particles-N "
+                       "(por defecto: %(default)s)")
+    argp.add_argument("-s", "--size", default = "160x120",
+                help = "Tamaño de la imagen, ANCHOxALTO (%(default)s)")
+    argp.add_argument("-r", "--repeat", type = int, default = 1,
+                help = "Repeticiones de cada escena, se guarda la más rápida")
+    argp.add_argument("-a", "--accel", default = "auto",
+                help = "Estructuras de aceleración a comparar, separadas por "
+                       "comas: auto, bvh, grid (%(default)s)")
+    argp.add_argument("-w", "--wavefront", action = "store_true",
+                help = "Medir también el render por etapas (wavefront)")
+    argp.add_argument("-o", "--output",
+                help = "Archivo JSON con los resultados")
+    opts = argp.parse_args(args[1:])
+    width, height = (int(v) for v in opts.size.split("x"))
+
+    results = []
+    for name in opts.scenes:
+        for accel in opts.accel.split(","):
+            runs = [bench_scene(name, width, height, accel = accel)
+                        for _ in range(opts.repeat)]
+            best = min(runs, key = lambda res: res["total"])
+            print_result(best)
+            results.append(best)
+
+        if opts.wavefront:
+            runs = [bench_scene(name, width, height, wavefront = True)
+                        for _ in range(opts.repeat)]
+            best = min(runs, key = lambda res: res["total"])
+            print_result(best)
+            results.append(best)
+
+    if opts.output:
+        with open(opts.output, "w") as outfile:
+            json.dump({"revision": git_revision(),
+                       "python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "results": results}, outfile, indent = 2)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
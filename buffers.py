@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  buffers.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Geometría de la escena compilada a arrays contiguos por tipo de
+    primitiva (struct of arrays), para los kernels vectorizados del
+    render por etapas (ver wavefront.py), que es el único que los usa:
+    Scene.compile los genera solo para él. Las primitivas de Mesh y
+    SphereSet se agregan a las mismas tablas que Triangle y Sphere.
+
+        materials       (K, 3) float64  Colores
+        sphere_*        centers (S, 3), radii (S,)
+        tri_*           v0, e1 = v1 - v0, e2 = v2 - v0 (T, 3), normals
+                        (T, 3): la misma normal que devuelve el objeto
+                        (sin normalizar para Triangle); two_sided (T,):
+                        la normal se invierte hacia el rayo (Mesh)
+        plane_*         normals (P, 3), distances (P,)
+
+    Cada tabla tiene además, por primitiva:
+        *_material      Índice en materials (int32)
+        *_object        Índice del objeto en scene.els["objects"] (int32)
+        *_index         Índice dentro del objeto (Hit.index), -1 en los
+                        objetos simples (int64)
+"""
+
+import numpy as np
+
+from things import (Sphere, Plane, Triangle, Mesh, SphereSet,
+                    spheres_intersect, triangles_intersect)
+
+# Tipos de primitiva, en el orden de las tablas
+KINDS = ("sphere", "tri", "plane")
+KIND_SPHERE, KIND_TRI, KIND_PLANE = range(len(KINDS))
+
+# Columnas de cada array (además de las comunes material, object, index)
+BUFFER_LAYOUT = {
+        "sphere":   (("centers", 3, np.float64), ("radii", 1, np.float64)),
+        "tri":      (("v0", 3, np.float64), ("e1", 3, np.float64),
+                     ("e2", 3, np.float64), ("normals", 3, np.float64),
+                     ("two_sided", 1, np.bool_)),
+        "plane":    (("normals", 3, np.float64), ("distances", 1, np.float64))}
+COMMON_LAYOUT = (("material", 1, np.int32), ("object", 1, np.int32),
+                 ("index", 1, np.int64))
+
+
+def vec3_array(vecs):
+    return np.array([v.to_tuple() for v in vecs], dtype = float).reshape(-1, 3)
+
+
+def join(arrays, cols, dtype):
+    """ Concatena arrays en un array contiguo (n, cols), o (n,) si cols
+        es 1. Si solo uno de ellos tiene filas, y ya es contiguo y del
+        tipo dtype, se usa sin copiarlo (p.ej. los arrays mapeados de
+        Mesh y SphereSet).
+    """
+    shape = (-1, cols) if cols > 1 else (-1, )
+    arrays = [np.asarray(arr, dtype = dtype).reshape(shape) for arr in arrays]
+    full = [arr for arr in arrays if len(arr)]
+    if len(full) == 1 and full[0].flags.c_contiguous:
+        return full[0]
+    return np.ascontiguousarray(np.concatenate(arrays))
+
+
+
+class SceneBuffers:
+    def __init__(self, objects):
+        """ Empaqueta la geometría de objects (scene.els["objects"])
+        """
+        self.material_ids = {}          # Color -> índice en materials
+        self.materials = []             # Bloques (n, 3) de colores
+        self.nr_materials = 0
+        parts = {kind: [] for kind in KINDS}
+
+        simple = {Sphere: [], Triangle: [], Plane: []}
+        for nr, obj in enumerate(objects):
+            if type(obj) in simple:
+                simple[type(obj)].append((nr, obj))
+            elif isinstance(obj, Mesh):
+                parts["tri"].append(self.pack_mesh(nr, obj))
+            elif isinstance(obj, SphereSet):
+                parts["sphere"].append(self.pack_sphere_set(nr, obj))
+            else:
+                raise ValueError("No se puede compilar {}".format(type(obj).__name__))
+
+        # Los objetos simples de cada tipo se empaquetan juntos
+        spheres = [obj for _, obj in simple[Sphere]]
+        parts["sphere"].insert(0, self.common(simple[Sphere],
+                    centers = vec3_array(obj.location for obj in spheres),
+                    radii = [obj.radius for obj in spheres]))
+        tris = [obj for _, obj in simple[Triangle]]
+        parts["tri"].insert(0, self.common(simple[Triangle],
+                    v0 = vec3_array(obj.v0 for obj in tris),
+                    e1 = vec3_array(obj.edge0 for obj in tris),
+                    e2 = vec3_array(obj.v0v2 for obj in tris),
+                    normals = vec3_array(obj.n for obj in tris),
+                    two_sided = np.zeros(len(tris), dtype = bool)))
+        planes = [obj for _, obj in simple[Plane]]
+        parts["plane"].append(self.common(simple[Plane],
+                    normals = vec3_array(obj.normal for obj in planes),
+                    distances = [obj.distance for obj in planes]))
+
+        for kind in KINDS:
+            for name, cols, dtype in BUFFER_LAYOUT[kind] + COMMON_LAYOUT:
+                setattr(self, "{}_{}".format(kind, name),
+                        join([part[name] for part in parts[kind]], cols, dtype))
+
+        self.materials = np.concatenate([np.zeros((0, 3))] + self.materials)
+        del self.material_ids, self.nr_materials
+
+
+    def material(self, color):
+        """ Índice del color en materials (lo agrega si no está)
+        """
+        key = (color.r, color.g, color.b)
+        if key not in self.material_ids:
+            self.material_ids[key] = self.add_materials([key])
+        return self.material_ids[key]
+
+
+    def add_materials(self, colors):
+        """ Agrega los colores (n, 3) a materials. Devuelve el índice del
+            primero.
+        """
+        first = self.nr_materials
+        block = np.asarray(colors, dtype = float).reshape(-1, 3)
+        self.materials.append(block)
+        self.nr_materials += len(block)
+        return first
+
+
+    def material_array(self, color, colors, n):
+        """ Materiales de n primitivas: colors (n, 3) propios de cada una,
+            o el color común del objeto si colors es None
+        """
+        if colors is None:
+            return np.full(n, self.material(color), dtype = np.int32)
+        first = self.add_materials(colors)
+        return np.arange(first, first + n, dtype = np.int32)
+
+
+    def common(self, items, **columns):
+        """ Columnas comunes de los objetos simples items [(nr, obj)]
+        """
+        columns["material"] = [self.material(obj.get_color()) for _, obj in items]
+        columns["object"] = [nr for nr, _ in items]
+        columns["index"] = np.full(len(items), -1)
+        return columns
+
+
+    def pack_mesh(self, nr, mesh):
+        n = len(mesh.v0)
+        return {"v0": mesh.v0, "e1": mesh.e1, "e2": mesh.e2,
+                "normals": mesh.normals,
+                "two_sided": np.ones(n, dtype = bool),
+                "material": self.material_array(mesh.color, mesh.colors, n),
+                "object": np.full(n, nr),
+                "index": np.arange(n)}
+
+
+    def pack_sphere_set(self, nr, spheres):
+        n = len(spheres.centers)
+        return {"centers": spheres.centers, "radii": spheres.radii,
+                "material": self.material_array(spheres.color, spheres.colors, n),
+                "object": np.full(n, nr),
+                "index": np.arange(n)}
+
+
+    def arrays(self):
+        """ Diccionario nombre: array de todos los buffers (p.ej. para
+            geometry.write_geometry)
+        """
+        names = ["materials"] + ["{}_{}".format(kind, name)
+                                    for kind in KINDS
+                                    for name, _, _ in BUFFER_LAYOUT[kind] + COMMON_LAYOUT]
+        return {name: getattr(self, name) for name in names}
+
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.arrays().values())
+
+
+    def counts(self):
+        return {kind: len(getattr(self, kind + "_material")) for kind in KINDS}
+
+
+    def intersect(self, origins, dirs, tmin = 0):
+        """ Impacto más cercano de N rayos (origins, dirs (N, 3)) con todas
+            las primitivas, por fuerza bruta (ver spheres_intersect y
+            triangles_intersect). Los planos no se intersectan, como en
+            Plane.intersection.
+            Devuelve (t, kind, prim), (N,): distancia (inf si no hay
+            impacto), tipo (KIND_*, -1 si no hay impacto) y fila en las
+            tablas de ese tipo.
+        """
+        t, prim = spheres_intersect(origins, dirs, self.sphere_centers,
+                                    self.sphere_radii, tmin)
+        kind = np.where(prim >= 0, KIND_SPHERE, -1)
+        tt, _, _, tprim = triangles_intersect(origins, dirs, self.tri_v0,
+                                              self.tri_e1, self.tri_e2, tmin)
+        closer = tt < t
+        t = np.where(closer, tt, t)
+        kind[closer] = KIND_TRI
+        prim = np.where(closer, tprim, prim)
+        return t, kind, prim
+
+
+    def __str__(self):
+        return "SceneBuffers: {}, {} materiales, {:.1f} kB".format(
+                    ", ".join("{} {}".format(n, kind) for kind, n in self.counts().items()),
+                    len(self.materials), self.nbytes / 1024)
+
+
+
+def test_scene_buffers():
+    import pickle
+    import time
+    from render import load_scene
+
+    with open("demo1.rt") as infile:
+        scene = load_scene(infile.read())
+    scene.compile()
+    print(scene.buffers)
+    for name, arr in scene.buffers.arrays().items():
+        print("  {:18s} {:8s} {}".format(name, str(arr.dtype), arr.shape))
+
+    t0 = time.perf_counter()
+    objs = pickle.dumps(scene.els["objects"])
+    t1 = time.perf_counter()
+    bufs = pickle.dumps(scene.buffers)
+    t2 = time.perf_counter()
+    print("pickle: objetos {} bytes {:.6f} s, buffers {} bytes {:.6f} s".format(
+                len(objs), t1 - t0, len(bufs), t2 - t1))
+
+    cam = scene.els["cameras"][0]
+    origins, dirs, x0, y0 = cam.ray_arrays(160, 120)
+    t, kind, prim = scene.buffers.intersect(origins, dirs)
+    print("Impactos: {} de {}".format(int((kind >= 0).sum()), len(t)))
+
+
+def main(args):
+    test_scene_buffers()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
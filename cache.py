@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import os
+import pickle
+import tempfile
+from hashlib import sha256
+
+from parse import PARSER_VERSION
+from scene import Scene
+from geometry import geometry_bytes, read_geometry
+
+DEFAULT_CACHE_DIR = "~/.cache/rt"
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024      # bytes
+DEFAULT_ACCEL_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Cambiar si cambia la forma de las clases guardadas (Scene.els, things)
+SCENE_CACHE_VERSION = 4
+
+
+class DiskCache:
+    """ Archivos en un directorio, con un tamaño total máximo. Cuando se
+        supera, se borran los archivos usados hace más tiempo (LRU): la
+        fecha de modificación de cada archivo indica su último uso.
+    """
+    def __init__(self, directory = DEFAULT_CACHE_DIR,
+                       max_bytes = DEFAULT_CACHE_SIZE, suffix = ".bin"):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        os.makedirs(self.directory, exist_ok = True)
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+
+    def lookup(self, key):
+        """ Devuelve el nombre del archivo de key (marcándolo como usado),
+            o None si no está en el cache
+        """
+        fname = self.path(key)
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            return None
+        return fname
+
+
+    def store(self, key, data):
+        """ Guarda data (bytes) bajo key. La escritura es atómica: otro
+            proceso nunca ve un archivo a medio escribir.
+        """
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(data)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+
+    def discard(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+    def evict(self):
+        """ Borra los archivos menos usados hasta no superar max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+
+class SceneCache(DiskCache):
+    """ Escenas clasificadas, indexadas por el hash del texto fuente (y de
+        las versiones del parser y del formato, y del directorio de la
+        escena, desde el que se resuelven los archivos que nombra), para
+        no volver a parsear escenas que no cambiaron.
+    """
+    def __init__(self, directory = DEFAULT_CACHE_DIR,
+                       max_bytes = DEFAULT_CACHE_SIZE):
+        super(SceneCache, self).__init__(directory, max_bytes, ".scene")
+
+
+    def key(self, text, directory = ""):
+        h = sha256("{}:{}:{}:".format(PARSER_VERSION, SCENE_CACHE_VERSION,
+                                      os.path.abspath(directory)).encode())
+        h.update(text.encode())
+        return h.hexdigest()
+
+
+    def load(self, text, directory = ""):
+        """ Devuelve la escena clasificada de text (ver Scene.classify), o
+            None si no está
+        """
+        key = self.key(text, directory)
+        fname = self.lookup(key)
+        if fname is None:
+            return None
+
+        try:
+            with open(fname, "rb") as infile:
+                els = pickle.load(infile)
+        except Exception:               # Archivo dañado o incompatible
+            self.discard(key)
+            return None
+
+        scene = Scene()
+        scene.els = els
+        return scene
+
+
+    def save(self, text, scene, directory = ""):
+        self.store(self.key(text, directory),
+                   pickle.dumps(scene.els, pickle.HIGHEST_PROTOCOL))
+
+
+
+class AccelCache(DiskCache):
+    """ Estructuras de aceleración (BVH, Grid) como archivos de geometría
+        (ver geometry.py), indexadas por el hash de las cajas de las
+        primitivas (ver accel.make_accel). Se leen con memmap: no hace
+        falta reconstruirlas si la geometría no cambió.
+    """
+    def __init__(self, directory = DEFAULT_CACHE_DIR,
+                       max_bytes = DEFAULT_ACCEL_CACHE_SIZE):
+        super(AccelCache, self).__init__(directory, max_bytes, ".accel")
+
+
+    def load(self, key):
+        fname = self.lookup(key)
+        if fname is None:
+            return None
+
+        try:
+            return read_geometry(fname)
+        except (OSError, ValueError):   # Archivo dañado o incompatible
+            self.discard(key)
+            return None
+
+
+    def save(self, key, arrays):
+        self.store(key, geometry_bytes(arrays))
+
+
+
+def test_scene_cache():
+    from render import load_scene
+    with open("demo1.rt") as infile:
+        text = infile.read()
+
+    cache = SceneCache(tempfile.mkdtemp())
+    print("Antes:", cache.load(text))
+    cache.save(text, load_scene(text))
+    cache.load(text).dump()
+
+
+def test_accel_cache(n = 100000):
+    import time
+    import numpy as np
+    import accel
+
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, (n, 3))
+    accel.use_cache(AccelCache(tempfile.mkdtemp()))
+    for kind in ("bvh", "grid", "bvh", "grid"):
+        t0 = time.perf_counter()
+        accel.make_accel(centers - 0.05, centers + 0.05, kind)
+        print("{:5s} {:.3f} s".format(kind, time.perf_counter() - t0))
+    accel.use_cache(None)
+
+
+def main(args):
+    test_scene_cache()
+    # ~ test_accel_cache()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
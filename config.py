@@ -35,11 +35,15 @@ DEFAULT_CONFIG = """
 {
 "image": {
     "width": 400,
-    "height": 300},
+    "height": 300,
+    "progressive": 1,
+    "stats": 0},
 "editor": {
     "linenrs": 1},
 "scene": {
-    "ambient": 0.1}
+    "ambient": 0.1,
+    "accel": "auto",
+    "wavefront": 0}
 }
 """
 
@@ -63,13 +67,21 @@ class Config(Gtk.Frame):
                                         Gtk.Entry,  6),
                     ( "Height:",        int,    "height",
                                         Gtk.Entry,  6),
+                    ( "Progressive:",   bool,   "progressive",
+                                        Gtk.CheckButton),
+                    ( "Statistics:",    bool,   "stats",
+                                        Gtk.CheckButton),
 
                     ("Editor:",         "editor"),
                     ( "Line numbers:",  bool,   "linenrs",
                                         Gtk.CheckButton),
                     ("Scene:",          "scene"),
                     (  "Ambient light:", int,   "ambient",
-                                        Gtk.Entry,  12)):
+                                        Gtk.Entry,  12),
+                    (  "Accelerator:",  str,    "accel",
+                                        Gtk.ComboBoxText, ("auto", "bvh", "grid")),
+                    (  "Wavefront:",    bool,   "wavefront",
+                                        Gtk.CheckButton)):
             if len(spec) == 2:
                 lbl = Gtk.Label(label = spec[0])
                 self.grid.attach(lbl, 0, y, 1, 1)
@@ -91,9 +103,17 @@ class Config(Gtk.Frame):
 
                 elif rest[0] == Gtk.CheckButton:
                     wdg, = rest
-                    w = wdg(active = field)
+                    w = wdg(active = self.get_field(self.section, field))
                     w.connect("toggled", self.on_widget_change, self.section, field)
 
+                elif rest[0] == Gtk.ComboBoxText:
+                    wdg, choices = rest
+                    w = wdg()
+                    for choice in choices:
+                        w.append(choice, choice)
+                    w.set_active_id(self.get_field(self.section, field))
+                    w.connect("changed", self.on_widget_change, self.section, field)
+
                 self.grid.attach(w, 2, y, 1, 1)
                 y += 1
 
@@ -111,6 +131,9 @@ class Config(Gtk.Frame):
         elif isinstance(wdg, Gtk.CheckButton):
             self.set_field(section, field, 1 if wdg.get_active() else 0)
 
+        elif isinstance(wdg, Gtk.ComboBoxText):
+            self.set_field(section, field, wdg.get_active_id())
+
 
     def set_field(self, section, param, value):
         self.conf[section][param] = value
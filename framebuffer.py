@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  framebuffer.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import numpy as np
+from PIL import Image
+
+
+class Framebuffer:
+    """ Imagen en punto flotante (un array de NumPy (alto, ancho, 3), con
+        componentes de 0 a 1), que registra las líneas modificadas desde
+        la última consulta (ver take_dirty).
+    """
+    def __init__(self, width, height, buffer = None):
+        """ buffer      Memoria a usar (p.ej. shared_memory.buf). Si es
+                        None, se crea un framebuffer nuevo, en negro.
+        """
+        self.width, self.height = width, height
+        if buffer is None:
+            self.pixels = np.zeros((height, width, 3), dtype = np.float32)
+        else:
+            self.pixels = np.ndarray((height, width, 3), dtype = np.float32,
+                                     buffer = buffer)
+        self.dirty = None
+
+
+    def copy(self):
+        """ Copia independiente del framebuffer (sin regiones modificadas)
+        """
+        fb = Framebuffer(self.width, self.height)
+        fb.pixels[:] = self.pixels
+        return fb
+
+
+    @staticmethod
+    def nbytes(width, height):
+        """ Tamaño en bytes del buffer para una imagen de width x height
+        """
+        return width * height * 3 * np.dtype(np.float32).itemsize
+
+
+    def set_pixel(self, x, y, color):
+        self.pixels[y, x] = (color.r, color.g, color.b)
+        self.mark_dirty(y, y + 1)
+
+
+    def set_block(self, x, y, block):
+        """ Copia el array block (alto, ancho, 3) a partir del pixel x, y
+        """
+        h, w = block.shape[:2]
+        self.pixels[y:y + h, x:x + w] = block
+        self.mark_dirty(y, y + h)
+
+
+    def fill(self, x, y, w, h, color):
+        """ Pinta el rectángulo de w x h pixeles a partir de x, y con
+            color (recortado a los bordes de la imagen)
+        """
+        self.pixels[y:y + h, x:x + w] = (color.r, color.g, color.b)
+        self.mark_dirty(y, min(y + h, self.height))
+
+
+    def mark_dirty(self, y0, y1):
+        """ Marca las líneas y0 .. y1-1 como modificadas
+        """
+        if self.dirty is None:
+            self.dirty = (y0, y1)
+        else:
+            self.dirty = (min(self.dirty[0], y0), max(self.dirty[1], y1))
+
+
+    def take_dirty(self):
+        """ Devuelve el rango (y0, y1) de líneas modificadas desde la
+            última llamada (o None), y lo reinicia
+        """
+        dirty, self.dirty = self.dirty, None
+        return dirty
+
+
+    def to_uint8(self, y0 = 0, y1 = None):
+        """ Limita al rango 0..1 y cuantiza a 8 bits las líneas y0 .. y1-1
+            (todas por defecto). Trunca igual que RGB.as_tuple.
+        """
+        rows = self.pixels[y0:y1]
+        return np.clip(rows * 255, 0, 255).astype(np.uint8)
+
+
+    def image(self):
+        """ Devuelve la imagen como PIL.Image (RGB, 8 bits)
+        """
+        return Image.fromarray(self.to_uint8(), "RGB")
+
+
+
+def test_framebuffer():
+    from rtmath import RGB
+    fb = Framebuffer(4, 3)
+    fb.set_pixel(1, 1, RGB(2, 0.5, -1))
+    print(fb.take_dirty(), fb.take_dirty())
+    print(fb.to_uint8())
+
+
+def main(args):
+    test_framebuffer()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  geometry.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Archivo binario de geometría (*.rtg): un encabezado y arrays de
+    NumPy, que se leen con numpy.memmap (sin copiar ni convertir: la
+    carga es inmediata, y los procesos que abren el mismo archivo
+    comparten las páginas).
+
+        Encabezado      GEOMETRY_HEADER: magic, versión, cantidad de arrays
+        Tabla           GEOMETRY_ENTRY por array: nombre, dtype, filas,
+                        columnas, posición en el archivo
+        Datos           Cada array alineado a GEOMETRY_ALIGN bytes
+
+    Arrays de una malla (ver things.Mesh):
+        vertices        (N, 3) float64
+        faces           (M, 3) int32, índices en vertices
+        colors          (M, 3) float32, opcional: color de cada cara
+
+    En la escena:  mesh_file { "modelo.rtg" texture { ... } }
+
+    Para convertir un modelo Wavefront (*.obj):
+        python3 geometry.py modelo.obj modelo.rtg
+"""
+
+import os
+import struct
+
+import numpy as np
+
+GEOMETRY_MAGIC = b"RTGEOM\r\n"
+GEOMETRY_VERSION = 1
+GEOMETRY_HEADER = struct.Struct("<8sII")
+GEOMETRY_ENTRY = struct.Struct("<16s8sQQQ")
+GEOMETRY_ALIGN = 64
+
+MESH_DTYPES = {"vertices": np.dtype("<f8"),
+               "faces":    np.dtype("<i4"),
+               "colors":   np.dtype("<f4")}
+
+
+def geometry_bytes(arrays):
+    """ Contenido del archivo para los arrays (diccionario nombre: array
+        2D), como bytes
+    """
+    arrays = {name: np.ascontiguousarray(arr).reshape(len(arr), -1)
+                    for name, arr in arrays.items()}
+
+    offset = GEOMETRY_HEADER.size + GEOMETRY_ENTRY.size * len(arrays)
+    entries = []
+    for name, arr in arrays.items():
+        offset = -(-offset // GEOMETRY_ALIGN) * GEOMETRY_ALIGN
+        entries.append((name, arr, offset))
+        offset += arr.nbytes
+
+    data = bytearray(offset)
+    GEOMETRY_HEADER.pack_into(data, 0, GEOMETRY_MAGIC, GEOMETRY_VERSION,
+                              len(arrays))
+    for i, (name, arr, offset) in enumerate(entries):
+        GEOMETRY_ENTRY.pack_into(data, GEOMETRY_HEADER.size + i * GEOMETRY_ENTRY.size,
+                                 name.encode(), arr.dtype.str.encode(),
+                                 arr.shape[0], arr.shape[1], offset)
+        data[offset:offset + arr.nbytes] = arr.tobytes()
+    return bytes(data)
+
+
+def write_geometry(fname, arrays):
+    """ Escribe los arrays (diccionario nombre: array 2D) en fname
+    """
+    with open(fname, "wb") as outfile:
+        outfile.write(geometry_bytes(arrays))
+
+
+def read_geometry(fname):
+    """ Abre fname y devuelve un diccionario nombre: array (numpy.memmap,
+        de solo lectura)
+    """
+    with open(fname, "rb") as infile:
+        header = infile.read(GEOMETRY_HEADER.size)
+        if len(header) < GEOMETRY_HEADER.size:
+            raise ValueError("{}: no es un archivo de geometría".format(fname))
+        magic, version, nr_arrays = GEOMETRY_HEADER.unpack(header)
+        if magic != GEOMETRY_MAGIC:
+            raise ValueError("{}: no es un archivo de geometría".format(fname))
+        if version != GEOMETRY_VERSION:
+            raise ValueError("{}: versión {} no soportada".format(fname, version))
+        table = infile.read(GEOMETRY_ENTRY.size * nr_arrays)
+
+    arrays = {}
+    size = os.path.getsize(fname)
+    for i in range(nr_arrays):
+        name, dtype, rows, cols, offset = GEOMETRY_ENTRY.unpack_from(
+                                            table, i * GEOMETRY_ENTRY.size)
+        name = name.rstrip(b"\0").decode()
+        dtype = np.dtype(dtype.rstrip(b"\0").decode())
+        if offset + rows * cols * dtype.itemsize > size:
+            raise ValueError("{}: archivo incompleto ({})".format(fname, name))
+        if rows * cols == 0:            # memmap no acepta arrays vacíos
+            arrays[name] = np.zeros((rows, cols), dtype = dtype)
+        else:
+            arrays[name] = np.memmap(fname, dtype = dtype, mode = "r",
+                                     offset = offset, shape = (rows, cols))
+    return arrays
+
+
+def write_mesh(fname, vertices, faces, colors = None):
+    """ Escribe una malla, con los tipos de MESH_DTYPES
+    """
+    arrays = {"vertices": vertices, "faces": faces}
+    if colors is not None:
+        arrays["colors"] = colors
+    write_geometry(fname, {name: np.asarray(arr, dtype = MESH_DTYPES[name])
+                                for name, arr in arrays.items()})
+
+
+def read_obj(fname):
+    """ Lee vértices y caras de un archivo Wavefront (*.obj). Los
+        polígonos se dividen en triángulos (en abanico); se ignoran
+        normales, coordenadas de textura y materiales.
+        Devuelve (vertices, faces)
+    """
+    vertices, faces = [], []
+    with open(fname) as infile:
+        for line in infile:
+            if line.startswith("v "):
+                vertices.append(line.split()[1:4])
+            elif line.startswith("f "):
+                idx = [int(item.split("/")[0]) for item in line.split()[1:]]
+                # Índices desde 1, o negativos (relativos al final)
+                idx = [i - 1 if i > 0 else len(vertices) + i for i in idx]
+                faces += [(idx[0], idx[k], idx[k + 1]) for k in range(1, len(idx) - 1)]
+
+    return (np.array(vertices, dtype = float).reshape(-1, 3),
+            np.array(faces, dtype = np.int32).reshape(-1, 3))
+
+
+
+def test_geometry():
+    import tempfile
+    import time
+
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(-1, 1, (1000000, 3))
+    faces = rng.integers(0, len(vertices), (2000000, 3))
+    fname = os.path.join(tempfile.mkdtemp(), "test.rtg")
+
+    t0 = time.perf_counter()
+    write_mesh(fname, vertices, faces)
+    t1 = time.perf_counter()
+    arrays = read_geometry(fname)
+    t2 = time.perf_counter()
+    print("Escritura {:.3f} s, lectura {:.6f} s, {:.1f} MB".format(
+                t1 - t0, t2 - t1, os.path.getsize(fname) / 1e6))
+    for name, arr in arrays.items():
+        print("  {:10s} {} {}".format(name, arr.dtype, arr.shape))
+    print(np.array_equal(arrays["vertices"], vertices),
+          np.array_equal(arrays["faces"], faces))
+
+
+def main(args):
+    if len(args) == 3:
+        vertices, faces = read_obj(args[1])
+        write_mesh(args[2], vertices, faces)
+        print("{}: {} vértices, {} caras".format(args[2], len(vertices), len(faces)))
+        return 0
+
+    test_geometry()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
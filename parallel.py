@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  parallel.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Render en paralelo: la imagen se divide en tiles, que se renderizan
+    en un pool de procesos. Cada proceso recibe la escena una sola vez (al
+    iniciar) y escribe los pixeles directamente en un Framebuffer en
+    memoria compartida.
+"""
+
+import numpy as np
+import pickle
+from multiprocessing import Pool, shared_memory
+
+import accel
+from rtmath import Ray, new_vec3
+from framebuffer import Framebuffer
+
+TILE_SIZE = 32
+
+# Estado de cada proceso del pool (ver init_worker)
+worker = {}
+
+
+def tiles(width, height, size = TILE_SIZE):
+    """ Divide la imagen en tiles (x0, y0, x1, y1) de size x size pixeles
+    """
+    for y0 in range(0, height, size):
+        for x0 in range(0, width, size):
+            yield x0, y0, min(x0 + size, width), min(y0 + size, height)
+
+
+def init_worker(cache, scene, shm_name, width, height, ambient):
+    """ Inicializa un proceso del pool: recibe el cache de estructuras del
+        proceso principal (accel.accel_cache) y la escena clasificada (con
+        su BVH ya construido, como pickle), y se conecta al framebuffer
+        compartido. El cache se instala antes de recuperar la escena, que
+        puede construir estructuras (p.ej. Mesh).
+    """
+    accel.use_cache(cache)
+    shm = shared_memory.SharedMemory(name = shm_name)
+    worker["shm"] = shm
+    worker["fb"] = Framebuffer(width, height, shm.buf)
+    worker["scene"] = pickle.loads(scene)
+    worker["size"] = width, height
+    worker["ambient"] = ambient
+
+
+def render_tile(tile):
+    """ Renderiza un tile en el framebuffer compartido
+    """
+    scene, fb, ambient = worker["scene"], worker["fb"], worker["ambient"]
+    width, height = worker["size"]
+    x0, y0, x1, y1 = tile
+
+    block = np.zeros((y1 - y0, x1 - x0, 3))
+    location = scene.cam.location
+    _, dirs, xs, ys = scene.cam.ray_arrays(width, height, tile)
+    for (dx, dy, dz), x, y in zip(dirs.tolist(), xs.tolist(), ys.tolist()):
+        pixel_color = scene.trace_ray(Ray(location, new_vec3(dx, dy, dz)), ambient)
+        if pixel_color is not None:
+            block[y - y0, x - x0] = (pixel_color.r, pixel_color.g,
+                                     pixel_color.b)
+
+    # La imagen tiene el eje y invertido respecto a la cámara
+    fb.set_block(x0, height - y1, block[::-1])
+    return tile
+
+
+def render_parallel(scene, width, height, ambient, workers = None,
+                    tile_size = TILE_SIZE):
+    """ Renderiza la escena en paralelo.
+        workers     Cantidad de procesos (por defecto, uno por núcleo)
+        Devuelve (imagen, error), como render.render_file
+    """
+    error = scene.check()
+    if error is not None:
+        return None, error
+
+    scene.cam = scene.els["cameras"][0]
+    scene.build_accel()
+
+    shm = shared_memory.SharedMemory(create = True,
+                                     size = Framebuffer.nbytes(width, height))
+    try:
+        fb = Framebuffer(width, height, shm.buf)
+        fb.pixels[:] = 0
+        with Pool(workers, initializer = init_worker,
+                  initargs = (accel.accel_cache,
+                              pickle.dumps(scene, pickle.HIGHEST_PROTOCOL),
+                              shm.name, width, height, ambient)) as pool:
+            for _ in pool.imap_unordered(render_tile,
+                                         tiles(width, height, tile_size)):
+                pass
+
+        image = fb.image()
+        del fb
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return image, None
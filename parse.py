@@ -24,6 +24,7 @@
 
 import pyparsing as pp
 import numpy as np
+import time
 import pdb
 from collections import OrderedDict
 from numbers import Number
@@ -32,7 +33,45 @@ from things import Camera, Light, Sphere, Plane
 from scene import Scene
 
 
+def number_block(name, width, dtype):
+    """ Acción para un bloque '{ n, <a, b, c>, ... }' (vertex_vectors,
+        face_indices): lo convierte de una sola vez en un array de NumPy
+        (n, width), sin pasar por un token de pyparsing por número.
+    """
+    def action(s, loc, tkn):
+        text = tkn[1][1:-1]
+        for ch in "<>,":
+            text = text.replace(ch, " ")
+        values = np.array(text.split(), dtype = float)
+        if len(values) == 0 or len(values) - 1 != values[0] * width:
+            raise pp.ParseFatalException(s, loc,
+                        "{}: la cantidad de elementos no coincide".format(name))
+        return [[name, values[1:].astype(dtype).reshape(-1, width)]]
+    return action
+
+
+def mesh_triangles(tkn):
+    """ Convierte los triángulos de un 'mesh' a vertex_vectors y
+        face_indices (sin compartir vértices)
+    """
+    vertices = np.array([v.to_tuple() for v in tkn[0]], dtype = float)
+    faces = np.arange(len(vertices)).reshape(-1, 3)
+    return [["vertex_vectors", vertices], ["face_indices", faces]]
+
+
+# Cambiar cada vez que cambia la gramática o el resultado del parser
+# (invalida las escenas guardadas en cache.SceneCache)
+PARSER_VERSION = 5
+
+# Tamaño máximo del cache de 'packrat' (memoización de pyparsing), 0 para
+# no usarla. Con esta gramática las alternativas fallan en la primera
+# palabra clave, y la memoización resultó más lenta (ver test_parse_speed).
+PACKRAT_CACHE_SIZE = 0
+
+
 class Pov_parser:
+    grammar = None          # Compartida por todas las instancias (ver make_parser)
+
     def __init__(self):
         pass
 
@@ -50,16 +89,32 @@ class Pov_parser:
 
 
     def make_parser(self, which = "parser"):
+        """ Devuelve el elemento 'which' de la gramática (por defecto el
+            parser completo). La gramática se construye una sola vez por
+            proceso y se reutiliza.
+        """
+        if Pov_parser.grammar is None:
+            Pov_parser.grammar = self.build_grammar()
+        return Pov_parser.grammar[which]
+
+
+    def build_grammar(self):
+        """ Construye la gramática. Devuelve un diccionario con todos los
+            elementos, por nombre.
+        """
+        # Memoización: evita reevaluar las alternativas que fallan
+        if PACKRAT_CACHE_SIZE:
+            pp.ParserElement.enablePackrat(PACKRAT_CACHE_SIZE)
+
         open_par = pp.Literal("{").suppress()
         close_par = pp.Literal("}").suppress()
 
         unsigned = pp.Word(pp.nums)
         signed   = pp.Combine(pp.Optional(pp.oneOf("- +")) + unsigned)
 
-        floatn = pp.Combine(
-                    signed +
-                    pp.Optional(pp.Literal(".") + unsigned) +
-                    pp.Optional(pp.oneOf("e E") + signed))
+        # Equivalente a Combine(signed + Optional("." + unsigned) +
+        # Optional(oneOf("e E") + signed)), pero en un solo paso
+        floatn = pp.Regex(r"[-+]?\d+(\.\d+)?([eE][-+]?\d+)?")
         floatn = floatn.setParseAction(lambda tkn: float(tkn[0]))
 
         vector = (
@@ -173,11 +228,67 @@ class Pov_parser:
                         object_modifiers) + 
                    close_par)
 
+        # Bloque { ... } sin llaves internas, convertido por number_block
+        number_list = pp.Regex(r"\{[^{}]*\}")
+
+        vertex_vectors = (pp.Keyword("vertex_vectors") + number_list).setParseAction(
+                                number_block("vertex_vectors", 3, float))
+        face_indices = (pp.Keyword("face_indices") + number_list).setParseAction(
+                                number_block("face_indices", 3, np.intp))
 
-        graph_els = camera | light | sphere | plane | triangle
+        mesh2 = pp.Group(pp.Keyword("mesh2") +
+                   open_par +
+                   pp.Group(
+                        vertex_vectors +
+                        face_indices +
+                        object_modifiers) +
+                   close_par)
+
+        mesh_triangle = (pp.Keyword("triangle").suppress() +
+                   open_par +
+                        vector + pp.Literal(",").suppress() +
+                        vector + pp.Literal(",").suppress() +
+                        vector +
+                   close_par)
+
+        mesh = pp.Group(pp.Keyword("mesh") +
+                   open_par +
+                   pp.Group(
+                        pp.Group(pp.OneOrMore(mesh_triangle)).setParseAction(mesh_triangles) +
+                        object_modifiers) +
+                   close_par)
+
+        mesh_file = pp.Group(pp.Keyword("mesh_file") +
+                   open_par +
+                   pp.Group(
+                        pp.QuotedString('"').setParseAction(lambda t: [["file", t[0]]]) +
+                        object_modifiers) +
+                   close_par)
+
+        def file_param(name):
+            return (pp.Keyword(name) + pp.QuotedString('"')).setParseAction(
+                                            lambda t: [[name, t[1]]])
+
+        sphere_set = pp.Group(pp.Keyword("sphere_set") +
+                   open_par +
+                   pp.Group(
+                        (file_param("centers") &
+                         (file_param("radii") |
+                          (pp.Keyword("radius") + floatn).setParseAction(
+                                            lambda t: [["radius", t[1]]])) &
+                         pp.Optional(file_param("colors")) &
+                         pp.Optional((pp.Keyword("accel") + pp.oneOf("auto bvh grid")
+                                     ).setParseAction(lambda t: [["accel", t[1]]]))) +
+                        object_modifiers) +
+                   close_par)
+
+
+        graph_els = (camera | light | sphere | plane | triangle | mesh2 | mesh |
+                     mesh_file | sphere_set)
 
         parser = pp.OneOrMore(graph_els)
-        return eval(which)
+        return {name: el for name, el in locals().items()
+                            if isinstance(el, pp.ParserElement)}
 
 
 
@@ -193,7 +304,15 @@ def test_subexpression(element):
              'reflection':  ('reflection 0.7', ),
              "finish":      ('finish { reflection 0.6}', ),
              "rotate":      ('rotate <20, 40, 20>', ),
-             "triangle":    ( 'triangle {<1, 0, 0>, <0, 1, 0>, <0, 0, 1>}', )
+             "triangle":    ( 'triangle {<1, 0, 0>, <0, 1, 0>, <0, 0, 1>}', ),
+             "mesh2":       ( 'mesh2 { vertex_vectors { 4, <0, 0, 0>, <1, 0, 0>, <1, 1, 0>, <0, 1, 0> } '
+                                'face_indices { 2, <0, 1, 2>, <0, 2, 3> } '
+                                'texture { pigment { rgb <1, 1, 1> }} }', ),
+             "mesh":        ( 'mesh { triangle {<1, 0, 0>, <0, 1, 0>, <0, 0, 1>} '
+                                'triangle {<1, 0, 0>, <0, 1, 0>, <0, 0, -1>} }', ),
+             "mesh_file":   ( 'mesh_file { "modelo.rtg" texture { pigment { rgb <1, 1, 1> }} }', ),
+             "sphere_set":  ( 'sphere_set { centers "c.npy" radius 0.01 }',
+                              'sphere_set { radii "r.npy" colors "rgb.npy" centers "c.npy" accel grid }')
             }
 
     strings = TESTS[element]
@@ -234,6 +353,53 @@ def test_classifier():
     scene.dump()
 
 
+def make_test_script(nr_objects):
+    """ Genera una escena con nr_objects objetos (esferas y triángulos)
+    """
+    lines = ['camera { location <0, 0, -1> look_at <0, 0, 1> angle 30 }',
+             'light_source { <2, 5, 2>, rgb <1, 1, 1> }']
+    for i in range(nr_objects):
+        x = (i % 100) * 0.1 - 5
+        y = (i // 100 % 100) * 0.1 - 5
+        if i % 2:
+            lines.append('sphere {{ <{:.2f}, {:.2f}, 6>, 0.04 '
+                         'texture {{ pigment {{ rgb <0, 1, 0> }} }} }}'.format(x, y))
+        else:
+            lines.append('triangle {{ <{0:.2f}, {1:.2f}, 5.5>, <{0:.2f}, {2:.2f}, 5.5>, '
+                         '<{3:.2f}, {1:.2f}, 5.5> texture {{ pigment {{ rgb <0, 1, 1> }} }} }}'.format(
+                                x, y, y + 0.05, x + 0.05))
+    return "\n".join(lines)
+
+
+def test_parse_speed(counts = (1000, 10000, 50000)):
+    """ Tiempo de parseo de escenas grandes, con y sin memoización
+    """
+    pov = Pov_parser()
+    t0 = time.perf_counter()
+    parser = pov.make_parser()
+    t1 = time.perf_counter()
+    pov.make_parser()
+    t2 = time.perf_counter()
+    print("Gramática: {:.1f} ms (construir), {:.3f} ms (desde el cache)".format(
+                (t1 - t0) * 1e3, (t2 - t1) * 1e3))
+
+    for nr in counts:
+        script = make_test_script(nr)
+        for packrat in (0, 1024):
+            pp.ParserElement.disable_memoization()
+            if packrat:
+                pp.ParserElement.enablePackrat(packrat)
+            t0 = time.perf_counter()
+            parser.parseString(script)
+            dt = time.perf_counter() - t0
+            print("{:6d} objetos  {:7.0f} kB  packrat={:<5d} {:7.2f} s  {:8.0f} objetos/s".format(
+                        nr, len(script) / 1024, packrat, dt, nr / dt))
+
+    pp.ParserElement.disable_memoization()
+    if PACKRAT_CACHE_SIZE:
+        pp.ParserElement.enablePackrat(PACKRAT_CACHE_SIZE)
+
+
 def main(args):
     # ~ test_subexpression("floatn")
     # ~ test_subexpression("vector")
@@ -245,7 +411,10 @@ def main(args):
     # ~ test_subexpression(("texture")
     # ~ test_subexpression("reflection")
     # ~ test_subexpression("finish")
+    # ~ test_parse_speed()
     test_subexpression("triangle")
+    # ~ test_subexpression("mesh2")
+    # ~ test_subexpression("mesh")
     #test_classifier()
     return 0
 
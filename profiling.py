@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  profiling.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Perfilado de un render con cProfile. Genera dos archivos por corrida,
+    con el nombre de la escena y la resolución:
+
+        demo1-400x300.pstats        Para pstats, snakeviz, etc.
+        demo1-400x300.collapsed     Pilas "a;b;c <microsegundos>", para
+                                    flamegraph.pl, speedscope, etc.
+
+    cProfile no guarda pilas completas, solo pares (llamador, llamado):
+    las pilas se reconstruyen repartiendo el tiempo de cada función entre
+    sus llamados según el tiempo acumulado de cada par.
+"""
+
+import cProfile
+import os
+import pstats
+from contextlib import contextmanager
+
+DEFAULT_PROFILE_DIR = "profiles"
+
+# Profundidad máxima de las pilas reconstruidas
+COLLAPSED_MAX_DEPTH = 64
+
+
+def profile_tag(name, width, height):
+    """ Nombre base de los archivos: escena y resolución
+    """
+    name = os.path.splitext(os.path.basename(name))[0] or "scene"
+    return "{}-{}x{}".format(name, width, height)
+
+
+def func_label(func):
+    """ Etiqueta de una función de pstats (archivo, línea, nombre)
+    """
+    fname, line, name = func
+    if fname == "~":                    # Funciones internas (C)
+        return name.strip("<>").replace(" ", "_")
+    return "{}:{}:{}".format(os.path.basename(fname), line, name)
+
+
+def write_collapsed(stats, fname):
+    """ Escribe las pilas reconstruidas de stats (pstats.Stats) en formato
+        'collapsed' (una pila por línea, separada por ';', y el tiempo
+        propio en microsegundos)
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+
+    stacks = {}
+
+    def walk(func, stack, scale):
+        tt, ct = stats.stats[func][2:4]
+        stack = stack + (func_label(func), )
+        key = ";".join(stack)
+        stacks[key] = stacks.get(key, 0) + tt * scale
+        if len(stack) >= COLLAPSED_MAX_DEPTH or ct <= 0:
+            return
+        for callee, (_, _, _, edge_ct) in callees.get(func, []):
+            if func_label(callee) in stack:     # Recursión
+                continue
+            callee_ct = stats.stats[callee][3]
+            if callee_ct > 0:
+                walk(callee, stack, scale * edge_ct / callee_ct)
+
+    roots = [func for func, st in stats.stats.items() if not st[4]]
+    for root in roots:
+        walk(root, (), 1)
+
+    with open(fname, "w") as outfile:
+        for key, t in sorted(stacks.items()):
+            us = int(round(t * 1e6))
+            if us > 0:
+                outfile.write("{} {}\n".format(key, us))
+
+
+@contextmanager
+def profiled(directory, tag):
+    """ Perfila el bloque with y guarda directory/tag.pstats y
+        directory/tag.collapsed. Produce la lista de archivos (que se
+        completa al salir del bloque).
+    """
+    files = []
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield files
+    finally:
+        profiler.disable()
+        os.makedirs(directory, exist_ok = True)
+        base = os.path.join(directory, tag)
+        profiler.dump_stats(base + ".pstats")
+        write_collapsed(pstats.Stats(profiler), base + ".collapsed")
+        files += [base + ".pstats", base + ".collapsed"]
+
+
+
+def test_profiled():
+    import tempfile
+    from render import render_file
+
+    directory = tempfile.mkdtemp()
+    with profiled(directory, profile_tag("demo1.rt", 80, 60)) as files:
+        render_file("demo1.rt", 80, 60)
+    print(files)
+    pstats.Stats(files[0]).sort_stats("cumulative").print_stats(10)
+    with open(files[1]) as infile:
+        print(infile.read()[:1000])
+
+
+def main(args):
+    test_profiled()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
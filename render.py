@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  render.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Render desde la línea de comandos, sin GTK:
+
+        python3 render.py demo1.rt -W 800 -H 600 -o demo1.png
+"""
+
+import argparse
+import os
+from contextlib import nullcontext
+
+from parse import Pov_parser
+from scene import Scene
+from parallel import render_parallel
+from cache import SceneCache, AccelCache, DEFAULT_CACHE_DIR
+from stats import RenderStats, CostMap
+from profiling import profiled, profile_tag
+from accel import ACCEL_KINDS, use_cache
+
+# Mismos valores por defecto que config.DEFAULT_CONFIG
+DEFAULT_WIDTH = 400
+DEFAULT_HEIGHT = 300
+DEFAULT_AMBIENT = 0.1
+
+
+def nullstage(name):
+    return nullcontext()
+
+
+def load_scene(text, cache = None, stats = None, directory = ""):
+    """ Parsea y clasifica el texto de una escena. Si se indica un cache
+        (SceneCache), se usa la escena guardada si el texto no cambió.
+        stats       RenderStats (opcional) donde anotar los tiempos
+        directory   Directorio de la escena: los archivos que nombra
+                    (mesh_file, ...) se buscan desde allí
+    """
+    stage = nullstage if stats is None else stats.stage
+    scene = None if cache is None else cache.load(text, directory)
+    if scene is None:
+        with stage("parse"):
+            pparser = Pov_parser()
+            parser = pparser.make_parser()
+            result = parser.parseString(text).asList()
+
+        with stage("classify"):
+            scene = Scene()
+            scene.classify(result, directory)
+        if cache is not None:
+            cache.save(text, scene, directory)
+
+    return scene
+
+
+def render_file(fname, width, height, ambient = DEFAULT_AMBIENT, jobs = 1,
+                cache = None, stats = None, costmap = None, accel = "auto",
+                wavefront = False):
+    """ Renderiza el archivo de escena fname.
+        jobs        Cantidad de procesos (0 = uno por núcleo)
+        cache       SceneCache para no volver a parsear (opcional)
+        stats       RenderStats (opcional). Con jobs != 1 solo se anotan
+                    los tiempos de parseo y clasificación.
+        costmap     CostMap (opcional) del tamaño de la imagen. No se usa
+                    con jobs != 1.
+        accel       Estructura de aceleración (ver accel.make_accel)
+        wavefront   Renderizar por etapas (ver wavefront.py), en un solo
+                    proceso (se ignora jobs)
+        Devuelve (imagen, error): la imagen (PIL) o un mensaje de error
+    """
+    with open(fname) as infile:
+        text = infile.read()
+
+    scene = load_scene(text, cache, stats, os.path.dirname(fname))
+    scene.accel_kind = accel
+    if jobs != 1 and not wavefront:
+        return render_parallel(scene, width, height, ambient, jobs or None)
+
+    error = scene.render(width, height, ambient, stats = stats,
+                         costmap = costmap, wavefront = wavefront)
+    if error is not None:
+        return None, error
+
+    return scene.cam.image, None
+
+
+def main(args):
+    argp = argparse.ArgumentParser(
+                description = "Renderiza una escena (*.rt) sin interfaz gráfica")
+    argp.add_argument("scene",
+                help = "Archivo de escena (*.rt)")
+    argp.add_argument("-W", "--width", type = int, default = DEFAULT_WIDTH,
+                help = "Ancho de la imagen (%(default)s)")
+    argp.add_argument("-H", "--height", type = int, default = DEFAULT_HEIGHT,
+                help = "Alto de la imagen (%(default)s)")
+    argp.add_argument("-a", "--ambient", type = float, default = DEFAULT_AMBIENT,
+                help = "Intensidad de la luz ambiente (%(default)s)")
+    argp.add_argument("-j", "--jobs", type = int, default = 1,
+                help = "Procesos en paralelo, 0 = uno por núcleo (%(default)s)")
+    argp.add_argument("--accel", choices = ACCEL_KINDS, default = "auto",
+                help = "Estructura de aceleración: BVH, grilla uniforme, o "
+                       "elegida según los tamaños de los objetos (%(default)s)")
+    argp.add_argument("--wavefront", action = "store_true",
+                help = "Renderizar por etapas, con todos los rayos de cada "
+                       "etapa a la vez (ignora -j)")
+    argp.add_argument("--cache-dir", default = DEFAULT_CACHE_DIR,
+                help = "Directorio del cache de escenas y de estructuras de "
+                       "aceleración (%(default)s)")
+    argp.add_argument("--no-cache", action = "store_true",
+                help = "No usar el cache de escenas ni el de estructuras "
+                       "de aceleración")
+    argp.add_argument("-o", "--output", default = "render.png",
+                help = "Archivo de imagen a generar (%(default)s)")
+    argp.add_argument("--stats", metavar = "JSON",
+                help = "Contar rayos y pruebas de intersección, y guardarlos "
+                       "en el archivo indicado")
+    argp.add_argument("--heatmap", metavar = "NOMBRE",
+                help = "Guardar el costo de cada pixel en NOMBRE.png (falsos "
+                       "colores) y NOMBRE.npy (solo con -j 1, sin --wavefront)")
+    argp.add_argument("--heatmap-metric", choices = ("time", "tests"),
+                default = "time",
+                help = "Costo a medir: ns o pruebas de intersección por pixel "
+                       "(%(default)s)")
+    argp.add_argument("--profile", metavar = "DIR",
+                help = "Perfilar parseo, clasificación y render con cProfile, "
+                       "y guardar .pstats y .collapsed en DIR (con -j, solo "
+                       "el proceso principal)")
+    opts = argp.parse_args(args[1:])
+    if opts.heatmap is not None and (opts.jobs != 1 or opts.wavefront):
+        argp.error("--heatmap solo se puede usar con -j 1 y sin --wavefront")
+
+    cache = None
+    if not opts.no_cache:
+        cache = SceneCache(opts.cache_dir)
+        use_cache(AccelCache(opts.cache_dir))
+    stats = None if opts.stats is None else RenderStats()
+    costmap = None
+    if opts.heatmap is not None:
+        costmap = CostMap(opts.width, opts.height, opts.heatmap_metric)
+    if opts.profile is None:
+        profiler = nullcontext([])
+    else:
+        profiler = profiled(opts.profile,
+                            profile_tag(opts.scene, opts.width, opts.height))
+    with profiler as files:
+        image, error = render_file(opts.scene, opts.width, opts.height,
+                                   opts.ambient, opts.jobs, cache, stats,
+                                   costmap, opts.accel, opts.wavefront)
+    for fname in files:
+        print("Perfil:", fname)
+    if error is not None:
+        print(error)
+        return 1
+
+    image.save(opts.output)
+    if stats is not None:
+        print(stats.report())
+        stats.save(opts.stats)
+    if costmap is not None:
+        costmap.save(opts.heatmap)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -32,10 +32,14 @@ gi.require_version('GtkSource', '3.0')
 from gi.repository import Gdk, Gtk, GooCanvas, Pango, GtkSource
 
 from PIL import Image
-from parse import Pov_parser
 import json
+import os
 from config import Config
-from scene import Scene
+from render import load_scene
+from cache import SceneCache, AccelCache
+from accel import use_cache
+from stats import RenderStats
+from profiling import profiled, profile_tag, DEFAULT_PROFILE_DIR
 
 PROG = "RT"
 VERSION = "0.10.19"
@@ -111,7 +115,9 @@ class MainWindow(Gtk.Window):
         mainmenu.add_items_to("File", (
                 ("Save scene file como ...", self.on_save_scene_as),
                 ("Open scene file...", self.on_open_scene)))
-        mainmenu.add_items_to("Tools", (("Renderizar", self.on_render_clicked), ))
+        mainmenu.add_items_to("Tools", (
+                ("Renderizar con perfil", self.on_profile_clicked),
+                ("Renderizar", self.on_render_clicked)))
         vbox.pack_start(mainmenu, False, False, 0)
 
         # Agregar notebook con editor y imagen
@@ -137,6 +143,11 @@ class MainWindow(Gtk.Window):
         self.config = Config()
         self.nb.append_page(self.config, Gtk.Label(label = "Configure"))
 
+        self.scene_cache = SceneCache()
+        use_cache(AccelCache())
+        self.last_scene = None          # Para re-renderizar solo lo que cambió
+        self.scene_name = "scene"       # Nombre del último archivo abierto
+
         self.add(vbox)
         self.show_all()
 
@@ -165,6 +176,7 @@ class MainWindow(Gtk.Window):
             with open(fname) as infile:
                 text = infile.read()
             self.edit_buffer.set_text(text)
+            self.scene_name = fname
 
         fc.destroy()
 
@@ -196,6 +208,7 @@ class MainWindow(Gtk.Window):
                             self.edit_buffer.get_end_iter(),
                             False)
                 outfile.write(text)
+            self.scene_name = fname
 
 
         fc.destroy()
@@ -221,13 +234,25 @@ class MainWindow(Gtk.Window):
 
         self.nb.set_current_page(1)
 
-        pparser = Pov_parser()
-        parser = pparser.make_parser()
-        result = parser.parseString(text)
+        stats = RenderStats() if self.config.conf["image"]["stats"] else None
+        scene = load_scene(text, self.scene_cache, stats,
+                           os.path.dirname(self.scene_name))
+        if scene.tracer(self, self.last_scene, stats) is None:
+            self.last_scene = scene
+            if stats is not None:
+                print(stats.report())
+
 
-        scene = Scene()
-        scene.classify(result)
-        scene.tracer(self)
+    def on_profile_clicked(self, menuitem):
+        """ Renderiza como on_render_clicked, perfilando con cProfile.
+            Los archivos quedan en DEFAULT_PROFILE_DIR.
+        """
+        conf = self.config.conf["image"]
+        with profiled(DEFAULT_PROFILE_DIR, profile_tag(
+                        self.scene_name, conf["width"], conf["height"])) as files:
+            self.on_render_clicked(menuitem)
+        for fname in files:
+            print("Perfil:", fname)
 
 
     def run(self):
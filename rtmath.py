@@ -27,6 +27,8 @@ from math import sqrt
 
 epsilon = 1e-10
 
+_new = object.__new__
+
 """
  ____   ____ ____
 |  _ \ / ___| __ )
@@ -40,6 +42,7 @@ class RGB:
     """ Almacena los componentes de colores en formato RGB. Cada
         componente tiene  rango de 0 a 1.
     """
+    __slots__ = ("r", "g", "b")
 
     def __init__(self, r, g = 0.0, b = 0.0):
         """ Constructor recibe los colores en formato:
@@ -80,22 +83,47 @@ class RGB:
     def __add__(self, val_rgb2):
         """ Suma, componente por componente
         """
-        return RGB(self.r + val_rgb2.r,
-                   self.g + val_rgb2.g,
-                   self.b + val_rgb2.b)
+        return new_rgb(self.r + val_rgb2.r,
+                       self.g + val_rgb2.g,
+                       self.b + val_rgb2.b)
 
 
     def __mul__(self, factor):
         """ Multipla los 3 componentes por un factor (=escalea)
         """
         if isinstance(factor, RGB):
-            return RGB(self.r * factor.r,
-                       self.g * factor.g,
-                       self.b * factor.b)
+            return new_rgb(self.r * factor.r,
+                           self.g * factor.g,
+                           self.b * factor.b)
         else:
-            return RGB(self.r * factor,
-                       self.g * factor,
-                       self.b * factor)
+            return new_rgb(self.r * factor,
+                           self.g * factor,
+                           self.b * factor)
+
+
+    def iadd(self, val_rgb2):
+        """ Suma en el lugar (sin crear una nueva instancia), para
+            acumuladores. Devuelve self.
+        """
+        self.r += val_rgb2.r
+        self.g += val_rgb2.g
+        self.b += val_rgb2.b
+        return self
+
+
+    def imul(self, factor):
+        """ Multiplica en el lugar, por un factor o por otro RGB.
+            Devuelve self.
+        """
+        if isinstance(factor, RGB):
+            self.r *= factor.r
+            self.g *= factor.g
+            self.b *= factor.b
+        else:
+            self.r *= factor
+            self.g *= factor
+            self.b *= factor
+        return self
 
 
     def as_tuple(self):
@@ -110,6 +138,15 @@ class RGB:
         self.b = min(self.b, 1.0)
 
 
+def new_rgb(r, g, b):
+    """ Constructor rápido de RGB a partir de los componentes (evita el
+        despacho por tipo de RGB.__init__)
+    """
+    c = _new(RGB)
+    c.r, c.g, c.b = r, g, b
+    return c
+
+
 class RGB_colors:
     Black   = RGB(0, 0, 0)
 
@@ -150,6 +187,8 @@ class VEC3:
     """ Clase almacena y define operaciones con vectores de 3 componentes
         x, y, z : Compoentes del vector
     """
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, x, y = 0, z = 0):
         """ Constructor recibe datos de las siguiente formas
             x, y, z:    float   Componentes separados
@@ -191,13 +230,13 @@ class VEC3:
     def __add__(self, v2):
         """ Suma
         """
-        return VEC3(self.x + v2.x, self.y + v2.y, self.z + v2.z)
+        return new_vec3(self.x + v2.x, self.y + v2.y, self.z + v2.z)
 
 
     def __sub__(self, v2):
         """ Resta
         """
-        return VEC3(self.x - v2.x, self.y - v2.y, self.z - v2.z)
+        return new_vec3(self.x - v2.x, self.y - v2.y, self.z - v2.z)
 
 
     def __mul__(self, v2):
@@ -206,15 +245,15 @@ class VEC3:
         if isinstance(v2, VEC3):
             return self.x*v2.x + self.y*v2.y + self.z*v2.z
         else:
-            return VEC3(self.x*v2, self.y*v2, self.z*v2)
+            return new_vec3(self.x*v2, self.y*v2, self.z*v2)
 
 
     def __matmul__(self, v3):
         """ Producto cruz (vectorial)
         """
-        return VEC3(self.y * v3.z - self.z * v3.y,
-                    self.z * v3.x - self.x * v3.z,
-                    self.x * v3.y - self.y * v3.x)
+        return new_vec3(self.y * v3.z - self.z * v3.y,
+                        self.z * v3.x - self.x * v3.z,
+                        self.x * v3.y - self.y * v3.x)
 
 
     def normalize(self):
@@ -225,17 +264,52 @@ class VEC3:
 
 
     def normalized(self):
-        d = abs(self)
-        v = VEC3(self.x / d,
-                 self.y / d,
-                 self.z / d)
-        return v
+        d = sqrt(self.x*self.x + self.y*self.y + self.z*self.z)
+        return new_vec3(self.x / d,
+                        self.y / d,
+                        self.z / d)
+
+
+    def iadd(self, v2):
+        """ Suma en el lugar (sin crear una nueva instancia). Devuelve self.
+        """
+        self.x += v2.x
+        self.y += v2.y
+        self.z += v2.z
+        return self
+
+
+    def isub(self, v2):
+        """ Resta en el lugar. Devuelve self.
+        """
+        self.x -= v2.x
+        self.y -= v2.y
+        self.z -= v2.z
+        return self
+
+
+    def imul(self, factor):
+        """ Escalea en el lugar. Devuelve self.
+        """
+        self.x *= factor
+        self.y *= factor
+        self.z *= factor
+        return self
 
 
     def to_tuple(self):
         return (self.x, self.y, self.z)
 
 
+def new_vec3(x, y, z):
+    """ Constructor rápido de VEC3 a partir de los componentes (evita el
+        despacho por tipo de VEC3.__init__)
+    """
+    v = _new(VEC3)
+    v.x, v.y, v.z = x, y, z
+    return v
+
+
 """
  ____
 |  _ \ __ _ _   _
@@ -250,6 +324,8 @@ class Ray:
         loc     Origen del rayo
         dir     Dirección del ray
     """
+    __slots__ = ("loc", "dir")
+
     def __init__(self, loc, dir):
         self.loc, self.dir = loc, dir
 
@@ -261,7 +337,9 @@ class Ray:
     def at(self, t):
         """ at      Ubicación a una distancia t
         """
-        return self.loc + self.dir * t
+        d = self.dir
+        loc = self.loc
+        return new_vec3(loc.x + d.x*t, loc.y + d.y*t, loc.z + d.z*t)
 
 """
  _   _ _ _
@@ -273,10 +351,16 @@ class Ray:
 """
 
 class Hit:
-    def __init__(self, impact, normal, thing):
+    __slots__ = ("impact", "normal", "thing", "index")
+
+    def __init__(self, impact, normal, thing, index = None):
+        """ index       Elemento de thing que fue impactado (p.ej. la cara
+                        de una Mesh), o None
+        """
         self.impact = impact
         self.normal = normal
         self.thing = thing
+        self.index = index
 
 
     def __str__(self):
@@ -22,13 +22,33 @@
 #
 #
 
-from rtmath import Ray, epsilon
-from things import Sphere, Plane, Triangle, Camera, Light
+from collections import Counter
+from contextlib import nullcontext
+from math import floor, ceil, sqrt
+
+from rtmath import Ray, RGB_colors, epsilon
+from framebuffer import Framebuffer
+from things import Sphere, Plane, Triangle, Mesh, SphereSet, Camera, Light
+from accel import make_accel
+from buffers import SceneBuffers
+from wavefront import WavefrontTracer
+import os
 import pdb
 
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import GdkPixbuf, GLib, Gtk
+try:
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import GdkPixbuf, GLib, Gtk
+except (ImportError, ValueError):       # Sin GTK solo se puede usar render()
+    GdkPixbuf = GLib = Gtk = None
+
+# Tamaño de los tiles en los que se divide la región a re-renderizar
+INCREMENTAL_TILE = 16
+
+# Parámetros que son nombres de archivo, por tipo de elemento: los
+# relativos se resuelven desde el directorio de la escena
+FILE_PARAMS = {"mesh_file": ("file", ),
+               "sphere_set": ("centers", "radii", "colors")}
 
 
 def pixbuf2image(pix):
@@ -57,8 +77,19 @@ def image2pixbuf(im):
 
 
 
+def resolve_paths(params, keys, directory):
+    """ Copia de params con los valores de keys (nombres de archivo)
+        relativos a directory
+    """
+    return [[key, os.path.join(directory, value)]
+                    if key in keys and isinstance(value, str) else [key, value]
+                for key, value in params]
+
+
+
 class Scene():
     def __init__(self):
+        self.accel_kind = "auto"        # Ver accel.make_accel
         self.clear()
 
 
@@ -68,10 +99,17 @@ class Scene():
                     "cameras": [],
                     "lights": [],
                     "objects": []}
+        self.accel = None
+        self.buffers = None
 
-    def classify(self, parsed):
-        things = {"sphere": Sphere, "plane": Plane, "triangle": Triangle}
-        print(parsed)
+    def classify(self, parsed, directory = ""):
+        """ Crea los objetos de la escena parseada. Los archivos que
+            nombra la escena (FILE_PARAMS) se buscan desde directory (el
+            del archivo de la escena), no desde el directorio actual.
+        """
+        things = {"sphere": Sphere, "plane": Plane, "triangle": Triangle,
+                  "mesh": Mesh, "mesh2": Mesh, "mesh_file": Mesh,
+                  "sphere_set": SphereSet}
         for key, value in parsed:
             if   key == "camera":
                 self.els["cameras"].append(Camera(value))
@@ -80,6 +118,8 @@ class Scene():
                 self.els["lights"].append(Light(value))
 
             elif key in things:
+                if key in FILE_PARAMS:
+                    value = resolve_paths(value, FILE_PARAMS[key], directory)
                 self.els["objects"].append(things[key](value))
 
             elif key[0] == "#":
@@ -88,12 +128,32 @@ class Scene():
             else:
                 print("Tipo de elemento no conocido ({})".format(key))
 
+        self.buffers = None             # Hay que volver a compilar
+
+
+    def compile(self):
+        """ Empaqueta la geometría de los objetos en arrays por tipo de
+            primitiva (self.buffers, ver buffers.py). Solo lo usa el
+            render por etapas (wavefront), que lo llama después de
+            classify; no hace nada si ya se hizo.
+        """
+        if self.buffers is None:
+            self.buffers = SceneBuffers(self.els["objects"])
+
 
     def things(self):
         for obj in self.els["objects"]:
             yield obj
 
 
+    def stage(self, name):
+        """ Context manager alrededor de cada etapa del render por etapas
+            (compile, primary, ...). No hace nada: RenderStats.attach lo
+            reemplaza para medir los tiempos.
+        """
+        return nullcontext()
+
+
     def lights(self):
         for light in self.els["objects"]:
             yield light
@@ -106,7 +166,55 @@ class Scene():
                 print("    {}".format(el))
 
 
+    def build_accel(self):
+        """ Construye la estructura de aceleración (self.accel_kind: BVH o
+            Grid) sobre los objetos acotados. Los objetos no acotados
+            (p.ej. Plane) se prueban aparte, uno por uno.
+        """
+        self.bounded, self.unbounded = [], []
+        lo, hi = [], []
+        for obj in self.els["objects"]:
+            box = obj.bounds()
+            if box is None:
+                self.unbounded.append(obj)
+            else:
+                self.bounded.append(obj)
+                lo.append(box[0])
+                hi.append(box[1])
+
+        self.accel = make_accel(lo, hi, self.accel_kind)
+        if lo:                          # Caja que contiene a todos los objetos
+            self.scene_box = (tuple(map(min, zip(*lo))), tuple(map(max, zip(*hi))))
+        else:
+            self.scene_box = None
+
+
+    def nearest_in(self, indices, ray, tmin, tmax):
+        """ Impacto más cercano entre los objetos acotados indicados, con
+            tmin < t < tmax. Devuelve (t, hit) o None.
+        """
+        nearest = None
+        for i in indices.tolist():      # indices: rebanada de un array
+            for hit in self.bounded[i].intersection(ray):
+                if tmin < hit.impact < tmax:
+                    tmax, nearest = hit.impact, hit
+
+        return None if nearest is None else (tmax, nearest)
+
+
     def find_nearest_thing_hit(self, ray):
+        if self.accel is not None:
+            nearest = None
+            for obj in self.unbounded:
+                for hit in obj.intersection(ray):
+                    if hit.impact > 0:
+                        if (nearest is None) or (hit.impact < nearest.impact):
+                            nearest = hit
+
+            tmax = float("inf") if nearest is None else nearest.impact
+            found = self.accel.nearest(ray, self.nearest_in, 0, tmax)
+            return nearest if found is None else found[1]
+
         hits = []
         for obj in self.els["objects"]:
             hits += obj.intersection(ray)
@@ -123,21 +231,132 @@ class Scene():
         return nearest
 
 
-    def tracer(self, toplevel):
-        """ para todos los rayos
-                para todos los objetos
-                    para el impacto mas cercano
-                        - luz ambiente (color)
-                        para cada fuente de luz
-                            para cada objeto ver si permite la luz
-                                si llega luz, determinar el ángulo de la luz
-                                    determinamos intensidad la luz -> difusa
-                                    determinar luz especular
+    def occludes_in(self, indices, ray, tmin, tmax):
+        """ Indica si alguno de los objetos acotados indicados corta al
+            rayo con tmin < t < tmax
         """
-        self.toplevel = toplevel
-        w = toplevel.config.conf["image"]["width"]
-        h = toplevel.config.conf["image"]["height"]
+        for i in indices.tolist():
+            if self.bounded[i].occludes(ray, tmin, tmax):
+                return True
+        return False
+
+
+    def occluded(self, ray, tmin = 0, tmax = float("inf")):
+        """ Consulta de sombra: indica si algún objeto corta al rayo con
+            tmin < t < tmax. Se detiene en el primer objeto encontrado.
+        """
+        if self.accel is None:
+            objects = self.els["objects"]
+        else:
+            objects = self.unbounded
+            if self.accel.any_hit(ray, self.occludes_in, tmin, tmax):
+                return True
+
+        for obj in objects:
+            if obj.occludes(ray, tmin, tmax):
+                return True
+        return False
+
+
+    def affected_rect(self, obj, w, h, shadows = True):
+        """ Rectángulo (x0, y0, x1, y1) de pixeles (de la cámara) cuyo
+            color puede depender de obj: su proyección y (si shadows) la de
+            las sombras que proyecta. None si no se puede acotar (hay que
+            renderizar toda la imagen).
+        """
+        box = obj.bounds()
+        if box is None:
+            return None
+        corners = [(x, y, z) for x in (box[0][0], box[1][0])
+                             for y in (box[0][1], box[1][1])
+                             for z in (box[0][2], box[1][2])]
+        loc = self.cam.location.to_tuple()
+        rels = [(x - loc[0], y - loc[1], z - loc[2]) for x, y, z in corners]
+
+        for light in (self.els["lights"] if shadows else []):
+            L = light.location.to_tuple()
+            # Distancia de la fuente a la caja (0 si está adentro)
+            dist = sqrt(sum(max(lo - p, 0, p - hi)**2
+                                for lo, hi, p in zip(box[0], box[1], L)))
+            if dist < epsilon:
+                return None
+
+            if self.unbounded or self.scene_box is None:
+                # La sombra puede llegar al infinito: se proyectan las
+                # direcciones (puntos en el infinito)
+                rels += [(x - L[0], y - L[1], z - L[2]) for x, y, z in corners]
+            else:
+                # La sombra solo cae sobre objetos dentro de scene_box:
+                # alcanza con extender la caja hasta ese alcance
+                reach = max(sqrt(sum((q - p)**2 for q, p in zip((x, y, z), L)))
+                                for x in (self.scene_box[0][0], self.scene_box[1][0])
+                                for y in (self.scene_box[0][1], self.scene_box[1][1])
+                                for z in (self.scene_box[0][2], self.scene_box[1][2]))
+                k = max(1, reach / dist)
+                rels += [tuple(p + (q - p) * k - l for q, p, l in zip(c, L, loc))
+                                for c in corners]
+
+        pixels = [self.cam.pixel_of(rel, w, h) for rel in rels]
+        if None in pixels:
+            return None
+
+        xs = [p[0] for p in pixels]
+        ys = [p[1] for p in pixels]
+        x0 = min(max(floor(min(xs)) - 1, 0), w)
+        x1 = min(max(ceil(max(xs)) + 2, 0), w)
+        y0 = min(max(floor(min(ys)) - 1, 0), h)
+        y1 = min(max(ceil(max(ys)) + 2, 0), h)
+        return x0, y0, x1, y1
+
+
+    def changed_region(self, previous, w, h, ambient):
+        """ Compara la escena con la renderizada antes (previous) y
+            devuelve la lista de rectángulos (x0, y0, x1, y1) que hay que
+            volver a trazar, o None si hay que renderizar todo (cambió la
+            cámara, las luces, el tamaño, o algún objeto no se puede
+            acotar). Requiere self.cam y build_accel().
+        """
+        if previous is None or getattr(previous, "rendered", None) != (w, h, ambient):
+            return None
 
+        for cat in ("cameras", "lights"):
+            if ([el.signature() for el in self.els[cat]] !=
+                    [el.signature() for el in previous.els[cat]]):
+                return None
+
+        old = Counter(obj.signature() for obj in previous.els["objects"])
+        new = Counter(obj.signature() for obj in self.els["objects"])
+        removed, added = old - new, new - old
+        gone = [obj for obj in previous.els["objects"] if obj.signature() in removed]
+        born = [obj for obj in self.els["objects"] if obj.signature() in added]
+        changed = gone + born
+
+        # Si solo cambió la textura (la forma está antes y después), las
+        # sombras no cambian
+        same_shape = (Counter(obj.shape_signature() for obj in gone) &
+                      Counter(obj.shape_signature() for obj in born))
+
+        # Los rectángulos se marcan en una grilla de tiles, para no trazar
+        # dos veces los pixeles donde se superponen
+        ts = INCREMENTAL_TILE
+        marked = set()
+        for obj in changed:
+            rect = self.affected_rect(obj, w, h,
+                                      obj.shape_signature() not in same_shape)
+            if rect is None:
+                return None
+            x0, y0, x1, y1 = rect
+            marked.update((tx, ty) for ty in range(y0 // ts, (y1 + ts - 1) // ts)
+                                   for tx in range(x0 // ts, (x1 + ts - 1) // ts))
+
+        return [(tx * ts, ty * ts, min((tx + 1) * ts, w), min((ty + 1) * ts, h))
+                    for tx, ty in sorted(marked, key = lambda t: (t[1], t[0]))]
+
+
+    def check(self):
+        """ Verifica que la escena se pueda renderizar. Devuelve un mensaje
+            de error, o None
+        """
         if len(self.els["cameras"]) != 1:
             return "Tiene que existir exactamente una sola cámara. Hay {}.".format(
                         len(self.els["cameras"]))
@@ -145,45 +364,202 @@ class Scene():
         if len(self.els["objects"]) == 0:
             return "No hay objetos en la escena"
 
-        self.cam = self.els["cameras"][0]
-        ray_gen = self.cam.ray_generator(w, h)
-        GLib.timeout_add(500, self.on_timeout)
-        self.timer_runs = True
 
-        for ray, x0, y0 in ray_gen:
-            Gtk.main_iteration_do(False)
-            nearest_hit = self.find_nearest_thing_hit(ray)
-            if nearest_hit is None:   # No hay impactos: No ejecutamos el resto
-                continue
+    def trace_ray(self, ray, ambient):
+        """ para todos los objetos
+                para el impacto mas cercano
+                    - luz ambiente (color)
+                    para cada fuente de luz
+                        para cada objeto ver si permite la luz
+                            si llega luz, determinar el ángulo de la luz
+                                determinamos intensidad la luz -> difusa
+                                determinar luz especular
+            Devuelve el color del pixel, o None si el rayo no impacta nada
+        """
+        nearest_hit = self.find_nearest_thing_hit(ray)
+        if nearest_hit is None:   # No hay impactos: No ejecutamos el resto
+            return None
 
-            nearest_color = nearest_hit.thing.get_color()
-            pixel_color = nearest_color * toplevel.config.conf["scene"]["ambient"]
+        return self.shade(ray, nearest_hit, ambient)
 
-            for light in self.els["lights"]:
-                light_loc = light.param("location")
-                light_color = light.param("rgb")
 
-                incident = (ray.at(nearest_hit.impact) - light_loc).normalized()
-                light_ray = Ray(light_loc, incident)
+    def shade(self, ray, nearest_hit, ambient):
+        """ Color en el impacto nearest_hit del rayo ray: luz ambiente más
+            la difusa de cada fuente de luz que no esté tapada
+        """
+        nearest_color = nearest_hit.thing.hit_color(nearest_hit)
+        pixel_color = nearest_color * ambient
+
+        impact = ray.at(nearest_hit.impact)
+        for light in self.els["lights"]:
+            light_loc = light.location
+            light_color = light.color
+
+            incident = (impact - light_loc).normalized()
+            light_ray = Ray(light_loc, incident)
+
+            # Hay luz si ningún objeto está entre la fuente y el impacto
+            light_to_hit = abs(light_loc - impact)
+            if not self.occluded(light_ray, 0, light_to_hit - epsilon):
+                cos_ang = -(nearest_hit.normal * incident)
+                diffuse = nearest_color * light_color
+                pixel_color.iadd(diffuse * cos_ang)
+
+        return pixel_color
+
+
+    def render(self, w, h, ambient, progress = None, progressive = False,
+                     previous = None, stats = None, costmap = None,
+                     wavefront = False):
+        """ Renderiza la escena completa en self.cam.image, sin depender
+            de GTK.
+            w, h        Tamaño de la imagen
+            ambient     Intensidad de la luz ambiente
+            progress    Función (opcional) llamada al comenzar cada línea
+            progressive Renderizar de grueso a fino (ver
+                        Camera.progressive_generator), para tener una vista
+                        previa reconocible lo antes posible
+            previous    Escena renderizada antes. Si solo cambiaron algunos
+                        objetos, se reutiliza su imagen y se vuelven a
+                        trazar solo los pixeles afectados (ver
+                        changed_region)
+            stats       RenderStats (opcional) donde contar rayos, pruebas
+                        de intersección y tiempos
+            costmap     CostMap (opcional) donde anotar el costo de cada
+                        pixel
+            wavefront   Renderizar por etapas (ver wavefront.py). Se
+                        ignoran progressive, previous y costmap; progress
+                        se llama entre etapas y entre paquetes de rayos, y
+                        stats anota los tiempos de cada etapa (no cuenta
+                        rayos ni pruebas).
+            Devuelve un mensaje de error, o None
+        """
+        if stats is not None:
+            return stats.measure(self, w, h, ambient, progress, progressive,
+                                 previous, costmap = costmap,
+                                 wavefront = wavefront)
 
-                nearest_light_hit = self.find_nearest_thing_hit(light_ray)
+        error = self.check()
+        if error is not None:
+            return error
 
-                if nearest_light_hit is None:       # imposible
-                    continue
+        self.cam = self.els["cameras"][0]
+        self.rendered = (w, h, ambient)
+
+        if wavefront:                   # Usa los buffers, no el BVH
+            with self.stage("compile"):
+                self.compile()
+            # La vista previa (on_timeout) lee cam.fb durante el render
+            self.cam.fb = Framebuffer(w, h)
+            WavefrontTracer(self).render(w, h, ambient, self.stage, progress,
+                                         self.cam.fb)
+            return
+
+        self.build_accel()
+
+        rects = self.changed_region(previous, w, h, ambient)
+        if rects is not None:
+            self.cam.fb = fb = previous.cam.fb.copy()
+            fb.mark_dirty(0, h)
+            for x0, y0, x1, y1 in rects:    # El eje y de la imagen está invertido
+                fb.fill(x0, h - y1, x1 - x0, y1 - y0, RGB_colors.Black)
+            progressive = False
+            rays = ((ray, x0, y0, 1)
+                        for ray, x0, y0 in self.cam.tile_generator(w, h, rects))
+        elif progressive:
+            rays = self.cam.progressive_generator(w, h)
+        else:
+            rays = ((ray, x0, y0, 1)
+                        for ray, x0, y0 in self.cam.ray_generator(w, h))
+
+        if costmap is not None:
+            costmap.attach(self)
+
+        try:
+            row = None
+            for ray, x0, y0, size in rays:
+                if y0 != row:
+                    row = y0
+                    if progress is not None:
+                        progress()
+
+                if costmap is None:
+                    pixel_color = self.trace_ray(ray, ambient)
+                else:
+                    pixel_color = costmap.trace(self, ray, ambient, x0, h - y0 - 1)
+                if pixel_color is None:
+                    if not progressive:     # El fondo ya es negro
+                        continue
+                    pixel_color = RGB_colors.Black
+
+                if size == 1:
+                    self.cam.set_pixel(x0, h - y0 - 1, pixel_color)
+                else:                       # Bloque ampliado (eje y invertido)
+                    top = max(0, h - y0 - size)
+                    self.cam.fb.fill(x0, top, size, h - y0 - top, pixel_color)
+        finally:
+            if costmap is not None:     # Aunque falle el render
+                costmap.detach(self)
+
+
+    def tracer(self, toplevel, previous = None, stats = None):
+        """ Renderiza la escena mostrando el progreso en la ventana
+            principal (toplevel). previous, stats: ver render.
+        """
+        self.toplevel = toplevel
+        w = toplevel.config.conf["image"]["width"]
+        h = toplevel.config.conf["image"]["height"]
 
-                light_to_hit = abs(light_loc - ray.at(nearest_hit.impact))
-                if (nearest_light_hit.impact - light_to_hit) > -epsilon:
-                    cos_ang = -(nearest_light_hit.normal * incident)
-                    diffuse = nearest_color * light_color
-                    pixel_color += diffuse * cos_ang
+        error = self.check()
+        if error is not None:
+            return error
 
-            self.cam.set_pixel(x0, h - y0 - 1, pixel_color)
+        self.accel_kind = toplevel.config.conf["scene"]["accel"]
+        self.pixbuf = None
+        GLib.timeout_add(500, self.on_timeout)
+        self.timer_runs = True
+
+        error = self.render(w, h, toplevel.config.conf["scene"]["ambient"],
+                            self.pump_events,
+                            toplevel.config.conf["image"]["progressive"],
+                            previous, stats,
+                            wavefront = toplevel.config.conf["scene"]["wavefront"])
 
         self.timer_runs = False
+        return error
+
+
+    def pump_events(self):
+        """ Procesa los eventos pendientes de GTK (una vez por línea, no
+            por pixel)
+        """
+        while Gtk.events_pending():
+            Gtk.main_iteration_do(False)
 
 
     def on_timeout(self):
-        self.toplevel.render.set_from_pixbuf(image2pixbuf(self.cam.image))
+        """ Actualiza la vista previa con las líneas del framebuffer que
+            cambiaron desde la última vez. El pixbuf de la vista se crea
+            una sola vez; solo se convierte y copia la región modificada.
+        """
+        fb = self.cam.fb
+        if self.pixbuf is None:
+            self.pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+                                               False, 8, fb.width, fb.height)
+            self.pixbuf.fill(0)
+
+        dirty = fb.take_dirty()
+        if dirty is not None:
+            y0, y1 = dirty
+            data = GLib.Bytes.new(fb.to_uint8(y0, y1).tobytes())
+            region = GdkPixbuf.Pixbuf.new_from_bytes(data,
+                        GdkPixbuf.Colorspace.RGB, False, 8,
+                        fb.width, y1 - y0, fb.width * 3)
+            region.copy_area(0, 0, fb.width, y1 - y0, self.pixbuf, 0, y0)
+            # Gtk.Image guarda una superficie creada a partir del pixbuf:
+            # hay que volver a asignarlo para que muestre los cambios
+            self.toplevel.render.set_from_pixbuf(self.pixbuf)
+
         return self.timer_runs
 
 
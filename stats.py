@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  stats.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Estadísticas de un render: rayos primarios y de sombra, pruebas de
+    intersección por tipo de primitiva, impactos, y tiempo por etapa
+    (RenderStats), y el costo de cada pixel (CostMap).
+
+    Los contadores no están en el código del render: RenderStats.attach
+    reemplaza, solo en las instancias de la escena que se renderiza, los
+    métodos a contar por versiones que cuentan (y detach los quita). Sin
+    estadísticas, el render no paga nada.
+"""
+
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+# Escala de colores del mapa de costo: (posición, (r, g, b)), de negro
+# (barato) a blanco (caro)
+HEATMAP_COLORS = ((0.0,  (0, 0, 0)),
+                  (0.25, (40, 20, 140)),
+                  (0.5,  (190, 40, 110)),
+                  (0.75, (250, 140, 20)),
+                  (1.0,  (255, 255, 230)))
+
+# Percentil del costo que corresponde al extremo de la escala (los pocos
+# pixeles más caros no aplastan al resto)
+HEATMAP_PERCENTILE = 99.5
+
+
+def counted(func, counter, key):
+    """ Devuelve func, contando cada llamada en counter[key]
+    """
+    def wrapper(*args):
+        counter[key] += 1
+        return func(*args)
+    return wrapper
+
+
+
+class RenderStats:
+    def __init__(self):
+        self.stages = {}                # Segundos por etapa
+        self.rays = Counter()           # primary, shadow
+        self.tests = Counter()          # Pruebas de intersección, por tipo
+        self.hits = 0                   # Rayos primarios que impactan
+        self.misses = 0
+        self.size = None
+
+
+    @contextmanager
+    def stage(self, name):
+        """ Acumula el tiempo del bloque with en la etapa name
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0) +
+                                 time.perf_counter() - t0)
+
+
+    def attach(self, scene):
+        """ Instala los contadores en la escena y en sus objetos
+        """
+        def trace_ray(ray, ambient, trace_ray = scene.trace_ray):
+            self.rays["primary"] += 1
+            color = trace_ray(ray, ambient)
+            if color is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return color
+
+        def build_accel(build_accel = scene.build_accel):
+            with self.stage("accel"):
+                build_accel()
+
+        scene.trace_ray = trace_ray
+        scene.build_accel = build_accel
+        scene.stage = self.stage        # Etapas del render por etapas
+        scene.occluded = counted(scene.occluded, self.rays, "shadow")
+        for obj in scene.els["objects"]:
+            kind = type(obj).__name__
+            obj.intersection = counted(obj.intersection, self.tests, kind)
+            obj.occludes = counted(obj.occludes, self.tests, kind)
+
+
+    def detach(self, scene):
+        """ Quita los contadores instalados por attach
+        """
+        for name in ("trace_ray", "build_accel", "occluded", "stage"):
+            scene.__dict__.pop(name, None)
+        for obj in scene.els["objects"]:
+            obj.__dict__.pop("intersection", None)
+            obj.__dict__.pop("occludes", None)
+
+
+    def measure(self, scene, w, h, *args, **kwargs):
+        """ Ejecuta scene.render(w, h, ...) con los contadores instalados.
+            Devuelve el resultado de render.
+        """
+        self.size = (w, h)
+        self.attach(scene)
+        try:
+            with self.stage("render"):
+                error = scene.render(w, h, *args, **kwargs)
+        finally:
+            self.detach(scene)
+
+        # El trazado es el render menos la preparación: construcción del
+        # BVH, o compilación de los buffers (wavefront)
+        self.stages["trace"] = self.stages["render"] - sum(
+                    self.stages.get(name, 0) for name in ("accel", "compile"))
+        return error
+
+
+    def as_dict(self):
+        rays = sum(self.rays.values())
+        tests = sum(self.tests.values())
+        return {"size": self.size,
+                "stages": self.stages,
+                "primary_rays": self.rays["primary"],
+                "shadow_rays": self.rays["shadow"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "tests": dict(self.tests),
+                "tests_per_ray": tests / rays if rays else 0}
+
+
+    def save(self, fname):
+        with open(fname, "w") as outfile:
+            json.dump(self.as_dict(), outfile, indent = 2)
+
+
+    def report(self):
+        d = self.as_dict()
+        lines = ["Etapas:   " + "  ".join("{} {:.3f} s".format(name, t)
+                                            for name, t in d["stages"].items()),
+                 "Rayos:    {} primarios ({} impactos, {} sin impacto), "
+                        "{} de sombra".format(d["primary_rays"], d["hits"],
+                                              d["misses"], d["shadow_rays"]),
+                 "Pruebas:  " + "  ".join("{} {}".format(kind, n)
+                                            for kind, n in sorted(d["tests"].items())),
+                 "          {:.2f} objetos probados por rayo".format(d["tests_per_ray"])]
+        return "\n".join(lines)
+
+
+
+class CostMap:
+    """ Costo de cada pixel del render: el tiempo (ns) de trace_ray o la
+        cantidad de pruebas de intersección (incluyendo las de sombra).
+        Scene.render llama a trace por cada rayo primario.
+    """
+    def __init__(self, width, height, metric = "time"):
+        """ metric      "time" (ns por pixel) o "tests" (pruebas de
+                        intersección por pixel)
+        """
+        if metric not in ("time", "tests"):
+            raise ValueError("Métrica desconocida: {}".format(metric))
+        self.metric = metric
+        self.cost = np.zeros((height, width), dtype = np.float32)
+        self.counter = Counter()
+
+
+    def attach(self, scene):
+        """ Con metric == "tests", instala contadores en los objetos
+        """
+        self.saved = []
+        if self.metric == "tests":
+            for obj in scene.els["objects"]:
+                self.saved.append((obj, {name: obj.__dict__[name]
+                                            for name in ("intersection", "occludes")
+                                            if name in obj.__dict__}))
+                obj.intersection = counted(obj.intersection, self.counter, "tests")
+                obj.occludes = counted(obj.occludes, self.counter, "tests")
+
+
+    def detach(self, scene):
+        """ Deja los objetos como estaban antes de attach (que puede haber
+            encontrado los contadores de un RenderStats)
+        """
+        for obj, attrs in self.saved:
+            for name in ("intersection", "occludes"):
+                if name in attrs:
+                    setattr(obj, name, attrs[name])
+                else:
+                    obj.__dict__.pop(name, None)
+
+
+    def trace(self, scene, ray, ambient, x, y):
+        """ scene.trace_ray(ray, ambient), anotando el costo en el pixel
+            x, y (coordenadas de la imagen)
+        """
+        if self.metric == "time":
+            t0 = time.perf_counter_ns()
+            color = scene.trace_ray(ray, ambient)
+            self.cost[y, x] = time.perf_counter_ns() - t0
+        else:
+            self.counter["tests"] = 0
+            color = scene.trace_ray(ray, ambient)
+            self.cost[y, x] = self.counter["tests"]
+        return color
+
+
+    def image(self):
+        """ Imagen en falsos colores (PIL) del costo (ver HEATMAP_COLORS)
+        """
+        top = np.percentile(self.cost, HEATMAP_PERCENTILE)
+        level = np.clip(self.cost / top, 0, 1) if top > 0 else self.cost
+        stops = [pos for pos, _ in HEATMAP_COLORS]
+        rgb = np.stack([np.interp(level, stops, [color[c] for _, color in HEATMAP_COLORS])
+                            for c in range(3)], axis = -1)
+        return Image.fromarray(rgb.astype(np.uint8), "RGB")
+
+
+    def save(self, basename):
+        """ Guarda basename.png (falsos colores) y basename.npy (costo
+            sin procesar, float32)
+        """
+        self.image().save(basename + ".png")
+        np.save(basename + ".npy", self.cost)
+
+
+
+def test_render_stats():
+    from render import load_scene
+    with open("demo1.rt") as infile:
+        text = infile.read()
+
+    stats = RenderStats()
+    scene = load_scene(text, stats = stats)
+    stats.measure(scene, 80, 60, 0.1)
+    print(stats.report())
+
+
+def test_cost_map(metric = "tests"):
+    from render import load_scene
+    with open("demo1.rt") as infile:
+        text = infile.read()
+
+    costmap = CostMap(160, 120, metric)
+    load_scene(text).render(160, 120, 0.1, costmap = costmap)
+    print("Costo: mín {}  máx {}  total {}".format(
+                costmap.cost.min(), costmap.cost.max(), costmap.cost.sum()))
+    costmap.image().show()
+
+
+def main(args):
+    test_render_stats()
+    # test_cost_map()
+    # test_cost_map("time")
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
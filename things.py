@@ -27,21 +27,51 @@
 #               Base_object class defined, top class for all things in scene
 #               Modified test_sphere_hits to be clearer
 
-import pylab as plt
 import numpy as np
 import scipy
-from PIL import Image
-from math import radians, tan, sqrt
+from math import radians, tan, sqrt, inf
+from hashlib import sha256
 
 from collections import OrderedDict
 
-from rtmath import VEC3, RGB, RGB_colors, Ray, Hit, epsilon
+from rtmath import VEC3, RGB, RGB_colors, Ray, Hit, epsilon, new_vec3
+from framebuffer import Framebuffer
+from accel import (make_accel, BVH, cache_load, cache_save,
+                   ACCEL_CACHE_MIN, ACCEL_CACHE_VERSION)
+from geometry import read_geometry
+import os
 import pdb
 
+# Elementos máximos por array intermedio en los kernels vectorizados
+BATCH_ELEMENTS = 1 << 20
+
+# Paso inicial del render progresivo (1 pixel de cada 4 x 4)
+PROGRESSIVE_STEP = 4
+
+# Triángulos por hoja del BVH interno de Mesh (cada hoja se intersecta
+# con una sola operación de NumPy)
+MESH_LEAF_SIZE = 8
+
+# Datos por cara de Mesh, en el orden de las hojas del BVH (ver
+# Mesh.to_arrays)
+MESH_FACE_ARRAYS = ("v0", "e1", "e2", "n", "normals")
+
+# Esferas por hoja del BVH, o por celda de la Grid, internos de SphereSet
+SPHERE_SET_LEAF_SIZE = 16
+
 
 class Base_object:
     def __init__(self, params):
         self.params = params
+        self.compile()
+
+
+    def compile(self):
+        """ Resuelve los parámetros (una sola vez, al crear el objeto) a
+            atributos, para no recorrer self.params durante el render.
+            Las subclases lo redefinen.
+        """
+        pass
 
 
     def find(self, struct, *keys):
@@ -59,6 +89,46 @@ class Base_object:
         return self.find(self.params, *keys)
 
 
+    def required(self, *keys):
+        """ Como param, pero genera un error si el parámetro no existe
+        """
+        value = self.param(*keys)
+        if value is None:
+            raise ValueError("{}: falta el parámetro '{}'".format(
+                        type(self).__name__, " ".join(keys)))
+        return value
+
+
+    def has(self, key):
+        """ Indica si existe el parámetro key (aunque no tenga valor, como
+            'orthographic' o 'parallel')
+        """
+        return any(el[0] == key for el in self.params)
+
+
+    def get_color(self):
+        """ Color del objeto (texture/pigment/rgb). Por defecto negro,
+            como en POV-ray.
+        """
+        color = self.param("texture", "pigment", "rgb")
+        return RGB_colors.Black if color is None else color
+
+
+    def signature(self):
+        """ Identifica el contenido del objeto (tipo y parámetros), para
+            comparar dos versiones de una escena
+        """
+        return type(self).__name__, repr(self.params)
+
+
+    def shape_signature(self):
+        """ Como signature, pero sin la textura: dos objetos con la misma
+            forma proyectan las mismas sombras
+        """
+        return type(self).__name__, repr([el for el in self.params
+                                                if el[0] != "texture"])
+
+
     def __str__(self):
         return "{} {}".format(type(self).__name__, self.params)
 
@@ -85,27 +155,115 @@ class Camera(Base_object):
         super(Camera, self).__init__(params)
 
 
+    def compile(self):
+        self.orthographic = self.has("orthographic")
+        self.location = self.required("location")
+        self.angle = self.required("angle")
+        self.look_at = self.param("look_at")
+        self.up = self.param("up")
+
+
     def set_pixel(self, x, y, color):
-        self.image.putpixel((x, y), color.as_tuple())
+        self.fb.set_pixel(x, y, color)
 
 
-    def ray_generator(self, width, height):
-        bg_color = RGB_colors.Black.as_tuple()
-        self.image = Image.new("RGB", (width, height), bg_color)
+    @property
+    def image(self):
+        """ La imagen renderizada (PIL), cuantizada del framebuffer
+        """
+        return self.fb.image()
 
-        nr_pixels = width * height
-        h_size = 2 * tan(radians(self.param('angle'))/2)
-        v_size = h_size * height / width
+
+    def ray_arrays(self, width, height, tile = None):
+        """ Genera los rayos primarios en bloque, como arrays de NumPy.
+            tile        (x0, y0, x1, y1) limita los rayos a un rectángulo
+                        de la imagen (por defecto la imagen completa)
+            Devuelve origins (N, 3), dirs (N, 3) y las coordenadas x0, y0
+            (N,) de cada pixel, en el mismo orden que ray_generator.
+        """
+        if tile is None:
+            tile = (0, 0, width, height)
+        tx0, ty0, tx1, ty1 = tile
+
+        h_size = 2 * tan(radians(self.angle)/2)
         scale = h_size / (width - 1)
 
-        for pix in range(nr_pixels):
-            x0 = pix % width
-            y0 = pix // width
-            x = x0 - (width - 1)/2
-            y = y0 - (height - 1)/2
-            ray = Ray(self.param("location"),
-                      VEC3(x * scale, y * scale, 1).normalized())
-            yield ray, x0, y0
+        y0, x0 = np.mgrid[ty0:ty1, tx0:tx1]
+        x0 = x0.ravel()
+        y0 = y0.ravel()
+
+        dirs = np.empty((x0.size, 3))
+        dirs[:, 0] = (x0 - (width - 1)/2) * scale
+        dirs[:, 1] = (y0 - (height - 1)/2) * scale
+        dirs[:, 2] = 1
+        dirs /= np.sqrt(np.einsum("ij,ij->i", dirs, dirs))[:, np.newaxis]
+
+        origins = np.empty_like(dirs)
+        origins[:] = self.location.to_tuple()
+        return origins, dirs, x0, y0
+
+
+    def ray_generator(self, width, height):
+        self.fb = Framebuffer(width, height)
+        yield from self.tile_generator(width, height, [(0, 0, width, height)])
+
+
+    def tile_generator(self, width, height, tiles):
+        """ Genera los rayos (ray, x0, y0) de los rectángulos tiles
+            (x0, y0, x1, y1) de la imagen, sin tocar el framebuffer
+        """
+        location = self.location
+        for tx0, ty0, tx1, ty1 in tiles:
+            for row in range(ty0, ty1):     # Una fila por vez, limita la memoria
+                _, dirs, xs, ys = self.ray_arrays(width, height,
+                                                  (tx0, row, tx1, row + 1))
+                for (dx, dy, dz), x0, y0 in zip(dirs.tolist(), xs.tolist(),
+                                                ys.tolist()):
+                    yield Ray(location, new_vec3(dx, dy, dz)), x0, y0
+
+
+    def pixel_of(self, rel, width, height):
+        """ Inversa de ray_arrays: pixel (x0, y0), posiblemente fuera de la
+            imagen, donde se ve la dirección rel (tupla, relativa a la
+            ubicación de la cámara). None si rel no está delante de la
+            cámara.
+        """
+        x, y, z = rel
+        if z <= epsilon:
+            return None
+        scale = 2 * tan(radians(self.angle)/2) / (width - 1)
+        return (x / (z * scale) + (width - 1)/2,
+                y / (z * scale) + (height - 1)/2)
+
+
+    def progressive_generator(self, width, height, step = PROGRESSIVE_STEP):
+        """ Como ray_generator, pero en pasadas de grueso a fino. La primera
+            pasada traza un pixel de cada step x step; cada pasada siguiente
+            reduce step a la mitad y traza solo los pixeles nuevos.
+            step tiene que ser una potencia de 2.
+            Genera (ray, x0, y0, size), donde size es el lado del bloque
+            de pixeles que representa el rayo en esa pasada.
+        """
+        self.fb = Framebuffer(width, height)
+
+        location = self.location
+        first = True
+        while step >= 1:
+            for row in range(0, height, step):
+                _, dirs, xs, ys = self.ray_arrays(width, height,
+                                                  (0, row, width, row + 1))
+                if first or row % (2*step) != 0:
+                    cols = slice(0, None, step)
+                else:                   # Ya trazados en la pasada anterior
+                    cols = slice(step, None, 2*step)
+
+                for (dx, dy, dz), x0, y0 in zip(dirs[cols].tolist(),
+                                                xs[cols].tolist(),
+                                                ys[cols].tolist()):
+                    yield Ray(location, new_vec3(dx, dy, dz)), x0, y0, step
+
+            first = False
+            step //= 2
 
 """
      _     _       _     _
@@ -130,6 +288,12 @@ class Light(Base_object):
         super(Light, self).__init__(params)
 
 
+    def compile(self):
+        self.location = self.required("location")
+        self.color = self.required("rgb")
+        self.parallel = self.has("parallel")
+
+
 
 """
      _____ _     _              __ __
@@ -148,6 +312,30 @@ class Thing(Base_object):
     def intersection(self, ray):
         pass
 
+
+    def occludes(self, ray, tmin, tmax):
+        """ Indica si el objeto corta al rayo con tmin < t < tmax
+            (consulta de sombra: no hace falta el impacto más cercano)
+        """
+        for hit in self.intersection(ray):
+            if tmin < hit.impact < tmax:
+                return True
+        return False
+
+
+    def bounds(self):
+        """ Caja envolvente ((xmin, ymin, zmin), (xmax, ymax, zmax)), o
+            None si el objeto no es acotado (p.ej. Plane)
+        """
+        return None
+
+
+    def hit_color(self, hit):
+        """ Color en el impacto hit. Por defecto, el del objeto; los
+            objetos compuestos (Mesh) pueden usar hit.index.
+        """
+        return self.get_color()
+
 """
      ____        _
     / ___| _ __ | |__   ___ _ __ ___
@@ -170,17 +358,24 @@ class Sphere(Thing):
         super(Sphere, self).__init__(params)
 
 
+    def compile(self):
+        self.location = self.required("location")
+        self.radius = self.required("radius")
+        self.radius2 = self.radius**2
+        self.color = super(Sphere, self).get_color()
+
+
     def get_color(self):
-        return self.param("texture", "pigment", "rgb")
+        return self.color
 
 
     def intersection(self, ray):
-        location = self.param("location")
-        radius = self.param("radius")
+        location = self.location
 
         a = 1
-        b = ray.dir * (ray.loc - location) * 2
-        c = abs(ray.loc - location)**2 - radius**2
+        oc = ray.loc - location
+        b = ray.dir * oc * 2
+        c = oc * oc - self.radius2
 
         d = b*b - 4*a*c
         if abs(d) < epsilon: d = 0
@@ -198,6 +393,89 @@ class Sphere(Thing):
                     Hit(t2, (ray.at(t2) - location).normalized(), self)]
 
 
+    def occludes(self, ray, tmin, tmax):
+        oc = ray.loc - self.location
+        b = ray.dir * oc * 2
+        c = oc * oc - self.radius2
+
+        d = b*b - 4*c
+        if abs(d) < epsilon: d = 0
+        if d < 0:
+            return False
+
+        sq = sqrt(d)
+        return (tmin < (-b - sq)/2 < tmax) or (tmin < (-b + sq)/2 < tmax)
+
+
+    def bounds(self):
+        location = self.location
+        r = self.radius
+        return ((location.x - r, location.y - r, location.z - r),
+                (location.x + r, location.y + r, location.z + r))
+
+
+    @staticmethod
+    def intersect_batch(spheres, origins, dirs, tmin = 0):
+        """ Intersecta N rayos con todas las esferas de la lista a la vez.
+            Devuelve (t, ids): distancia al impacto más cercano (inf si no
+            hay impacto) e índice en spheres (-1 si no hay impacto).
+        """
+        centers = np.array([s.location.to_tuple() for s in spheres],
+                           dtype = float).reshape(-1, 3)
+        radii = np.array([s.radius for s in spheres], dtype = float)
+        return spheres_intersect(origins, dirs, centers, radii, tmin)
+
+
+def spheres_intersect(origins, dirs, centers, radii, tmin = 0):
+    """ Kernel vectorizado rayos/esferas.
+        origins, dirs   (N, 3)  Rayos
+        centers         (M, 3)  Centros de las esferas
+        radii           (M,)    Radios
+        tmin                    Solo se aceptan impactos con t > tmin
+        Devuelve (t, ids), ambos (N,): el t más cercano (inf si no hay
+        impacto) y el índice de la esfera (-1 si no hay impacto).
+        Las esferas se procesan en bloques para limitar la memoria a
+        BATCH_ELEMENTS elementos por array intermedio.
+    """
+    n = len(origins)
+    best_t = np.full(n, np.inf)
+    best_id = np.full(n, -1, dtype = np.intp)
+    if n == 0 or len(centers) == 0:
+        return best_t, best_id
+
+    a = np.einsum("ij,ij->i", dirs, dirs)[:, np.newaxis]
+    d_o = np.einsum("ij,ij->i", dirs, origins)[:, np.newaxis]
+    o_o = np.einsum("ij,ij->i", origins, origins)[:, np.newaxis]
+    rows = np.arange(n)
+
+    chunk = max(1, BATCH_ELEMENTS // n)
+    for first in range(0, len(centers), chunk):
+        c = centers[first:first + chunk]
+        r = radii[first:first + chunk]
+
+        # |o + t.d - c|² = r²  ->  a.t² + b.t + cc = 0
+        b = 2 * (d_o - dirs @ c.T)
+        cc = o_o - 2 * (origins @ c.T) + np.einsum("ij,ij->i", c, c) - r**2
+
+        disc = b*b - 4*a*cc
+        disc[np.abs(disc) < epsilon] = 0
+        miss = disc < 0
+        sq = np.sqrt(np.where(miss, 0, disc))
+
+        t = (-b - sq) / (2*a)                   # El más cercano primero
+        t2 = (-b + sq) / (2*a)
+        t = np.where(t > tmin, t, t2)
+        t[miss | (t <= tmin)] = np.inf
+
+        nearest = np.argmin(t, axis = 1)
+        t = t[rows, nearest]
+        closer = t < best_t
+        best_t[closer] = t[closer]
+        best_id[closer] = nearest[closer] + first
+
+    return best_t, best_id
+
+
 """
      ____  _
     |  _ \| | __ _ _ __   ___
@@ -220,6 +498,12 @@ class Plane(Thing):
         super(Plane, self).__init__(params)
 
 
+    def compile(self):
+        self.normal = self.required("normal")
+        self.distance = self.required("distance")
+        self.color = self.get_color()
+
+
     def intersection(self, ray):
         return []
 
@@ -246,22 +530,28 @@ class Triangle(Thing):
     def __init__(self, params):
         super(Triangle, self).__init__(params)
 
-    def get_color(self):
-        return self.param("texture", "pigment", "rgb")
 
+    def compile(self):
+        self.v0 = v0 = self.required("v0")
+        self.v1 = v1 = self.required("v1")
+        self.v2 = v2 = self.required("v2")
+        self.color = super(Triangle, self).get_color()
 
+        # Aristas, normal y distancia del plano: invariantes por rayo
+        self.edge0 = v1 - v0
+        self.edge1 = v2 - v1
+        self.edge2 = v0 - v2
+        self.v0v2 = v2 - v0
+        self.n = (self.edge0 @ self.v0v2) * -1
+        self.d = self.n * v0
+
+
+    def get_color(self):
+        return self.color
 
-    def intersection(self, ray):
-        v0 = self.param("v0")
-        v1 = self.param("v1")
-        v2 = self.param("v2")
 
-         # Vector unitario a la superficie del plano
-         
-        v0v1 = v1-v0
-        v0v2 = v2-v0
-        
-        n = (v0v1 @ v0v2) * -1
+    def intersection(self, ray):
+        n = self.n
 
         # Rayo paralelo o no al plano
 
@@ -269,33 +559,531 @@ class Triangle(Thing):
         if abs(nraydir) < epsilon :
             return []               # they are parallel so they don't intersect !
 
-        d = n * v0
-        t = (n * ray.loc+d) / nraydir
-        
+        t = (self.d - n * ray.loc) / nraydir
+
         if t < 0 :
-            return []               # the triangle is behind 
+            return []               # the triangle is behind
 
         p = ray.loc +  ray.dir * t
 
-        edge0 = v1 - v0
-        vp0 = p -v0
-        c1 = (edge0 @ vp0)*n
-        
-        
-        edge1 = v2 - v1
-        vp1 = p - v1
-        c2 = (edge1 @ vp1)*n
-        
-        
-        edge2 = v0 - v2
-        vp2 = p - v2
-        c3= (edge2 @ vp2)*n
-           
-           
+        c1 = (self.edge0 @ (p - self.v0))*n
+        c2 = (self.edge1 @ (p - self.v1))*n
+        c3 = (self.edge2 @ (p - self.v2))*n
+
         if c1 < 0 and c2 < 0 and c3 < 0 :       # P is on the right side
             return [Hit(t, n, self)]
         else :
-            return []       
+            return []
+
+
+    def bounds(self):
+        vs = (self.v0.to_tuple(), self.v1.to_tuple(), self.v2.to_tuple())
+        return tuple(map(min, *vs)), tuple(map(max, *vs))
+
+
+    @staticmethod
+    def intersect_batch(triangles, origins, dirs, tmin = 0):
+        """ Intersecta N rayos con todos los triángulos de la lista a la
+            vez. Devuelve (t, u, v, ids), ver triangles_intersect.
+        """
+        v0 = np.array([tr.v0.to_tuple() for tr in triangles],
+                      dtype = float).reshape(-1, 3)
+        e1 = np.array([tr.edge0.to_tuple() for tr in triangles],
+                      dtype = float).reshape(-1, 3)
+        e2 = np.array([tr.v0v2.to_tuple() for tr in triangles],
+                      dtype = float).reshape(-1, 3)
+        return triangles_intersect(origins, dirs, v0, e1, e2, tmin)
+
+
+def triangles_intersect(origins, dirs, v0, e1, e2, tmin = 0):
+    """ Kernel vectorizado rayos/triángulos (Möller-Trumbore).
+        origins, dirs   (N, 3)  Rayos
+        v0              (M, 3)  Primer vértice de cada triángulo
+        e1, e2          (M, 3)  Aristas v1 - v0 y v2 - v0 (precalculadas)
+        tmin                    Solo se aceptan impactos con t > tmin
+        Devuelve (t, u, v, ids), todos (N,): el t más cercano (inf si no
+        hay impacto), las coordenadas baricéntricas u, v del impacto y el
+        índice del triángulo (-1 si no hay impacto).
+    """
+    n = len(origins)
+    best_t = np.full(n, np.inf)
+    best_u = np.zeros(n)
+    best_v = np.zeros(n)
+    best_id = np.full(n, -1, dtype = np.intp)
+    if n == 0 or len(v0) == 0:
+        return best_t, best_u, best_v, best_id
+
+    d = dirs[:, np.newaxis, :]
+    rows = np.arange(n)
+
+    chunk = max(1, BATCH_ELEMENTS // (3 * n))
+    for first in range(0, len(v0), chunk):
+        cv0 = v0[first:first + chunk]
+        ce1 = e1[first:first + chunk]
+        ce2 = e2[first:first + chunk]
+
+        pvec = np.cross(d, ce2)                         # (N, M, 3)
+        det = np.einsum("nmk,mk->nm", pvec, ce1)
+        parallel = np.abs(det) < epsilon
+        inv_det = 1 / np.where(parallel, 1, det)
+
+        tvec = origins[:, np.newaxis, :] - cv0
+        u = np.einsum("nmk,nmk->nm", tvec, pvec) * inv_det
+        qvec = np.cross(tvec, ce1)
+        v = np.einsum("nmk,nmk->nm", d, qvec) * inv_det
+        t = np.einsum("nmk,mk->nm", qvec, ce2) * inv_det
+
+        miss = parallel | (u < 0) | (v < 0) | (u + v > 1) | (t <= tmin)
+        t[miss] = np.inf
+
+        nearest = np.argmin(t, axis = 1)
+        t = t[rows, nearest]
+        closer = t < best_t
+        best_t[closer] = t[closer]
+        best_u[closer] = u[rows, nearest][closer]
+        best_v[closer] = v[rows, nearest][closer]
+        best_id[closer] = nearest[closer] + first
+
+    return best_t, best_u, best_v, best_id
+
+
+"""
+     __  __           _
+    |  \/  | ___  ___| |__
+    | |\/| |/ _ \/ __| '_ \
+    | |  | |  __/\__ \ | | |
+    |_|  |_|\___||___/_| |_|
+
+"""
+
+class Mesh(Thing):
+    """ Malla de triángulos (mesh / mesh2 de POV-ray). Recibe parametros
+        de la escana:
+            - vertex_vectors    Vértices, array (N, 3)
+            - face_indices      Triángulos, array (M, 3) de índices en
+                                vertex_vectors
+          o bien
+            - file              Archivo de geometría (ver geometry.py),
+                                con vertices, faces y (opcional) colors
+            y propiedades comunes de objetos
+
+        Toda la malla es un solo objeto de la escena: los vértices y
+        caras quedan en arrays de NumPy, con un BVH propio sobre las
+        caras. A diferencia de Triangle, la normal se devuelve
+        normalizada y del lado del que viene el rayo (caras de dos lados,
+        como en POV-ray).
+        Si hay un cache de estructuras (accel.use_cache), los datos por
+        cara y el BVH de las mallas grandes se guardan en él, y se
+        mapean de allí en lugar de volver a calcularlos.
+    """
+    def __init__(self, params):
+        super(Mesh, self).__init__(params)
+
+
+    def compile(self):
+        self.fname = self.param("file")
+        colors = None
+        if self.fname is None:
+            self.vertices = np.asarray(self.required("vertex_vectors"), dtype = float)
+            self.faces = np.asarray(self.required("face_indices"))
+        else:                           # Arrays mapeados (memmap), sin copiar
+            arrays = read_geometry(self.fname)
+            self.vertices = arrays["vertices"]
+            self.faces = arrays["faces"]
+            colors = arrays.get("colors")
+        if len(self.faces) and (self.faces.min() < 0 or
+                                self.faces.max() >= len(self.vertices)):
+            raise ValueError("Mesh: índice de vértice fuera de rango")
+        self.color = super(Mesh, self).get_color()
+        self.hash = self.compute_digest()
+
+        self.mapped = False
+        self.key = None
+        if len(self.faces) >= ACCEL_CACHE_MIN:
+            self.key = self.cache_key()
+            if cache_load(self.key, self.open_arrays):
+                return
+
+        self.build(colors)
+        if self.key is not None and cache_save(self.key, self.to_arrays()):
+            # Mapeados del cache: no queda una copia en memoria
+            cache_load(self.key, self.open_arrays)
+
+
+    def build(self, colors):
+        """ Construye el BVH y los datos por cara
+        """
+        v0, v1, v2 = (self.vertices[self.faces[:, k]] for k in range(3))
+        lo = np.minimum(np.minimum(v0, v1), v2)
+        hi = np.maximum(np.maximum(v0, v1), v2)
+        self.accel = BVH(lo, hi, MESH_LEAF_SIZE)
+        if len(lo):
+            self.box = (tuple(lo.min(axis = 0).tolist()),
+                        tuple(hi.max(axis = 0).tolist()))
+        else:
+            self.box = None
+
+        # Datos por cara, en el orden de las hojas del BVH
+        perm = self.accel.sort_primitives()
+        v0, v1, v2 = v0[perm], v1[perm], v2[perm]
+        self.v0 = v0
+        self.e1 = v1 - v0
+        self.e2 = v2 - v0
+        self.n = np.cross(self.e1, self.e2)
+        length = np.linalg.norm(self.n, axis = 1, keepdims = True)
+        # Normal unitaria, orientada como Triangle.n
+        self.normals = -self.n / np.where(length > 0, length, 1)
+        self.colors = None if colors is None else colors[perm]
+
+
+    def cache_key(self):
+        return sha256("mesh:{}:{}:{}".format(ACCEL_CACHE_VERSION, MESH_LEAF_SIZE,
+                                             self.hash).encode()).hexdigest()
+
+
+    def to_arrays(self):
+        """ Datos por cara, caja y BVH, para guardarlos en el cache
+        """
+        arrays = self.accel.to_arrays()
+        del arrays["order"]             # range(n): ver sort_primitives
+        for name in MESH_FACE_ARRAYS:
+            arrays[name] = getattr(self, name)
+        if self.colors is not None:
+            arrays["colors"] = self.colors
+        arrays["box"] = np.array(self.box, dtype = float)
+        return arrays
+
+
+    def open_arrays(self, arrays):
+        """ Toma los datos por cara, la caja y el BVH de arrays (ver
+            to_arrays), sin copiarlos
+        """
+        n = len(self.faces)
+        for name in MESH_FACE_ARRAYS:
+            if arrays[name].shape != (n, 3):
+                raise ValueError("Mesh: {} no corresponde a la malla".format(name))
+        self.accel = BVH.from_arrays(arrays, range(n))
+        for name in MESH_FACE_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.colors = arrays.get("colors")
+        lo, hi = arrays["box"].tolist()
+        self.box = (tuple(lo), tuple(hi))
+        self.mapped = True
+        return True
+
+
+    def __getstate__(self):
+        """ Los arrays mapeados (del archivo de la malla o del cache) no se
+            guardan (pickle): al recuperarla se vuelven a mapear
+        """
+        state = dict(self.__dict__)
+        if self.fname is not None:
+            del state["vertices"], state["faces"]
+        if self.mapped:
+            for name in MESH_FACE_ARRAYS + ("colors", "accel"):
+                del state[name]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.fname is not None:
+            if self.compute_digest() != self.hash:
+                self.compile()          # Cambió el archivo
+                return
+            arrays = read_geometry(self.fname)
+            self.vertices = arrays["vertices"]
+            self.faces = arrays["faces"]
+        if self.mapped and not cache_load(self.key, self.open_arrays):
+            self.compile()              # Sin cache, o se borró la entrada
+
+
+    def hit_color(self, hit):
+        if self.colors is None:
+            return self.color
+        r, g, b = self.colors[hit.index].tolist()
+        return RGB(r, g, b)
+
+
+    def get_color(self):
+        return self.color
+
+
+    def signature(self):
+        """ Los arrays se identifican por su contenido (repr los abrevia)
+        """
+        return type(self).__name__, self.digest(), repr(self.other_params())
+
+
+    def shape_signature(self):
+        return type(self).__name__, self.digest(), repr([
+                    el for el in self.other_params() if el[0] != "texture"])
+
+
+    def other_params(self):
+        return [el for el in self.params
+                    if el[0] not in ("vertex_vectors", "face_indices")]
+
+
+    def digest(self):
+        """ Identifica la geometría (ver compute_digest)
+        """
+        return self.hash
+
+
+    def compute_digest(self):
+        """ Hash de los arrays, o nombre, tamaño y fecha del archivo. Se
+            calcula una sola vez, en compile: signature se llama para cada
+            objeto en cada re-render.
+        """
+        if self.fname is not None:      # No se lee todo el archivo
+            st = os.stat(self.fname)
+            return "{}:{}:{}".format(os.path.abspath(self.fname), st.st_size,
+                                     st.st_mtime_ns)
+        h = sha256()
+        h.update(np.ascontiguousarray(self.vertices).tobytes())
+        h.update(np.ascontiguousarray(self.faces).tobytes())
+        return h.hexdigest()
+
+
+    @staticmethod
+    def ray_arrays(ray):
+        """ Origen, dirección y matriz S (d x b = b @ S) del rayo
+        """
+        dx, dy, dz = ray.dir.x, ray.dir.y, ray.dir.z
+        return (np.array((ray.loc.x, ray.loc.y, ray.loc.z)),
+                np.array((dx, dy, dz)),
+                np.array(((0, dz, -dy), (-dz, 0, dx), (dy, -dx, 0))))
+
+
+    def distances(self, faces, o, d, S, tmin, tmax):
+        """ Distancias del rayo (o, d, S: ver ray_arrays) a las caras
+            faces (una rebanada): Möller-Trumbore, con los productos cruz
+            por d expresados con S. inf donde no hay impacto con
+            tmin < t < tmax.
+        """
+        det = -(self.n[faces] @ d)
+        parallel = np.abs(det) < epsilon
+        inv_det = 1 / np.where(parallel, 1, det)
+
+        tvec = o - self.v0[faces]
+        u = np.einsum("ij,ij->i", tvec, self.e2[faces] @ S) * inv_det
+        v = -np.einsum("ij,ij->i", tvec, self.e1[faces] @ S) * inv_det
+        t = np.einsum("ij,ij->i", tvec, self.n[faces]) * inv_det
+
+        t[parallel | (u < 0) | (v < 0) | (u + v > 1) | (t <= tmin) | (t >= tmax)] = inf
+        return t
+
+
+    def intersection(self, ray):
+        o, d, S = self.ray_arrays(ray)
+
+        def nearest_face(indices, ray, tmin, tmax):
+            t = self.distances(slice(indices.start, indices.stop), o, d, S, tmin, tmax)
+            k = int(np.argmin(t))
+            return None if t[k] == inf else (float(t[k]), indices.start + k)
+
+        found = self.accel.nearest(ray, nearest_face, 0, inf)
+        if found is None:
+            return []
+
+        t, face = found
+        nx, ny, nz = self.normals[face].tolist()
+        if nx * ray.dir.x + ny * ray.dir.y + nz * ray.dir.z > 0:
+            nx, ny, nz = -nx, -ny, -nz
+        return [Hit(t, new_vec3(nx, ny, nz), self, face)]
+
+
+    def occludes(self, ray, tmin, tmax):
+        o, d, S = self.ray_arrays(ray)
+
+        def any_face(indices, ray, tmin, tmax):
+            t = self.distances(slice(indices.start, indices.stop), o, d, S, tmin, tmax)
+            return bool((t < inf).any())
+
+        return self.accel.any_hit(ray, any_face, tmin, tmax)
+
+
+    def bounds(self):
+        return self.box
+
+
+    def __str__(self):
+        return "Mesh: {} vértices, {} caras {}".format(
+                    len(self.vertices), len(self.faces), self.other_params())
+
+
+
+"""
+     ____        _                      ____       _
+    / ___| _ __ | |__   ___ _ __ ___   / ___|  ___| |_
+    \___ \| '_ \| '_ \ / _ \ '__/ _ \  \___ \ / _ \ __|
+     ___) | |_) | | | |  __/ | |  __/   ___) |  __/ |_
+    |____/| .__/|_| |_|\___|_|  \___|  |____/ \___|\__|
+          |_|
+"""
+
+class SphereSet(Thing):
+    """ Conjunto de esferas (partículas) leído de archivos de NumPy
+        (*.npy, mapeados con mmap). Recibe parametros de la escana:
+            - centers       Archivo con los centros, array (N, 3)
+            - radii         Archivo con los radios, array (N,)
+          o bien
+            - radius        Radio común a todas las esferas
+            - colors        Archivo con el color de cada esfera, (N, 3)
+                            (opcional)
+            - accel         Estructura interna: auto, bvh o grid
+                            (ver accel.make_accel)
+            y propiedades comunes de objetos
+
+        Todo el conjunto es un solo objeto de la escena, con un BVH (o
+        Grid) propio. Los arrays no se copian ni se reordenan.
+    """
+    def __init__(self, params):
+        super(SphereSet, self).__init__(params)
+
+
+    def compile(self):
+        self.load_arrays()
+        r = self.radii[:, np.newaxis]
+        lo, hi = self.centers - r, self.centers + r
+        self.accel = make_accel(lo, hi, self.param("accel") or "auto",
+                                SPHERE_SET_LEAF_SIZE, SPHERE_SET_LEAF_SIZE)
+        if len(lo):
+            self.box = (tuple(lo.min(axis = 0).tolist()),
+                        tuple(hi.max(axis = 0).tolist()))
+        else:
+            self.box = None
+        self.files = self.file_stats()
+
+
+    def load_arrays(self):
+        """ Mapea los archivos (sin leerlos) y verifica sus dimensiones
+        """
+        self.centers = np.load(self.required("centers"), mmap_mode = "r")
+        n = len(self.centers)
+        if self.centers.shape != (n, 3):
+            raise ValueError("SphereSet: centers tiene que ser (N, 3)")
+
+        if self.param("radii") is not None:
+            self.radii = np.load(self.param("radii"), mmap_mode = "r")
+        else:
+            self.radii = np.full(n, float(self.required("radius")))
+        if self.radii.shape != (n, ):
+            raise ValueError("SphereSet: radii tiene que ser (N,)")
+
+        self.colors = None
+        if self.param("colors") is not None:
+            self.colors = np.load(self.param("colors"), mmap_mode = "r")
+            if self.colors.shape != (n, 3):
+                raise ValueError("SphereSet: colors tiene que ser (N, 3)")
+        self.color = super(SphereSet, self).get_color()
+
+
+    def __getstate__(self):
+        """ Los arrays mapeados no se guardan (pickle): al recuperarlo se
+            vuelven a mapear los archivos. La estructura de aceleración sí,
+            para no reconstruirla en cada proceso.
+        """
+        return {"params": self.params, "accel": self.accel, "box": self.box,
+                "files": self.files}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.file_stats() == self.files:
+            self.load_arrays()
+        else:                           # Cambiaron los archivos
+            self.compile()
+
+
+    def get_color(self):
+        return self.color
+
+
+    def hit_color(self, hit):
+        if self.colors is None:
+            return self.color
+        r, g, b = self.colors[hit.index].tolist()
+        return RGB(r, g, b)
+
+
+    def file_stats(self):
+        """ Nombre, tamaño y fecha de los archivos
+        """
+        files = []
+        for key in ("centers", "radii", "colors"):
+            fname = self.param(key)
+            if fname is not None:
+                st = os.stat(fname)
+                files.append((os.path.abspath(fname), st.st_size, st.st_mtime_ns))
+        return files
+
+
+    def signature(self):
+        """ Los archivos se identifican por nombre, tamaño y fecha
+        """
+        return type(self).__name__, repr(self.file_stats()), repr(self.params)
+
+
+    def shape_signature(self):
+        return self.signature()[:2] + (repr([el for el in self.params
+                                                if el[0] not in ("texture", "colors")]), )
+
+
+    def distances(self, indices, o, d, tmin, tmax):
+        """ Distancias del rayo (o, d: arrays, d unitario) a las esferas
+            indicadas. inf donde no hay impacto con tmin < t < tmax.
+        """
+        oc = o - self.centers[indices]
+        r = self.radii[indices]
+        b = oc @ d
+        disc = b*b - (np.einsum("ij,ij->i", oc, oc) - r*r)
+        sq = np.sqrt(np.maximum(disc, 0))
+        t = -b - sq                     # El más cercano primero
+        t = np.where(t > tmin, t, -b + sq)
+        t[(disc < 0) | (t <= tmin) | (t >= tmax)] = inf
+        return t
+
+
+    def intersection(self, ray):
+        o = np.array((ray.loc.x, ray.loc.y, ray.loc.z))
+        d = np.array((ray.dir.x, ray.dir.y, ray.dir.z))
+
+        def nearest_sphere(indices, ray, tmin, tmax):
+            t = self.distances(indices, o, d, tmin, tmax)
+            k = int(np.argmin(t))
+            return None if t[k] == inf else (float(t[k]), int(indices[k]))
+
+        found = self.accel.nearest(ray, nearest_sphere, 0, inf)
+        if found is None:
+            return []
+
+        t, i = found
+        cx, cy, cz = self.centers[i].tolist()
+        r = float(self.radii[i])
+        p = ray.at(t)
+        return [Hit(t, new_vec3((p.x - cx)/r, (p.y - cy)/r, (p.z - cz)/r), self, i)]
+
+
+    def occludes(self, ray, tmin, tmax):
+        o = np.array((ray.loc.x, ray.loc.y, ray.loc.z))
+        d = np.array((ray.dir.x, ray.dir.y, ray.dir.z))
+
+        def any_sphere(indices, ray, tmin, tmax):
+            return bool((self.distances(indices, o, d, tmin, tmax) < inf).any())
+
+        return self.accel.any_hit(ray, any_sphere, tmin, tmax)
+
+
+    def bounds(self):
+        return self.box
+
+
+    def __str__(self):
+        return "SphereSet: {} esferas {}".format(len(self.centers), self.params)
+
+
 
 def test_camera():
     pars = [['orthographic', None],
@@ -308,6 +1096,8 @@ def test_camera():
 
 
 def test_camera_rays():
+    import pylab as plt
+
     pars = [['orthographic', None],
             ['up', VEC3(0.0, 1.0, 0.0)],
             ['look_at', VEC3(0.0, 0.0, 0.0)],
@@ -324,6 +1114,15 @@ def test_camera_rays():
     plt.show()
 
 
+def test_camera_ray_arrays():
+    pars = [['angle', 60.0],
+            ['location', VEC3(5.0, 0.0, 0.0)]]
+    cam = Camera(pars)
+    origins, dirs, x0, y0 = cam.ray_arrays(32, 24, (8, 8, 12, 10))
+    print(origins.shape, dirs.shape)
+    print(np.column_stack((x0, y0, dirs)))
+
+
 
 def test_light():
     pars = [('location', VEC3(1, 2, 3)),
@@ -363,14 +1162,42 @@ def test_triangle():
     print(triangle)
 
 
+def test_mesh():
+    # Cuadrado de dos triángulos en z = 5
+    pars = [('vertex_vectors', np.array([(-1, -1, 5), (1, -1, 5), (1, 1, 5), (-1, 1, 5)])),
+            ('face_indices', np.array([(0, 1, 2), (0, 2, 3)]))]
+    mesh = Mesh(pars)
+    print(mesh.bounds())
+    for raydir in (VEC3(0, 0, 1), VEC3(0.1, 0.1, 1), VEC3(0.5, 0, 1)):
+        ray = Ray(VEC3(0, 0, 0), raydir.normalized())
+        for hit in mesh.intersection(ray):
+            print("  {} {} {}".format(raydir, hit.impact, hit.normal))
+
+
+def test_sphere_set():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    centers = os.path.join(directory, "centers.npy")
+    np.save(centers, np.array([(0, 0, 5), (0.5, 0, 4), (0, 3, 5)]))
+    spheres = SphereSet([('centers', centers), ('radius', 0.3)])
+    print(spheres, spheres.bounds())
+    for raydir in (VEC3(0, 0, 1), VEC3(0.12, 0, 1), VEC3(0, 0.6, 1)):
+        ray = Ray(VEC3(0, 0, 0), raydir.normalized())
+        for hit in spheres.intersection(ray):
+            print("  {} {} {} {}".format(raydir, hit.index, hit.impact, hit.normal))
+
+
 def main(args):
     # ~ test_camera()
     # ~ test_camera_rays()
+    # ~ test_camera_ray_arrays()
     # ~ test_light()
     test_sphere()
     # ~ test_sphere_hits()
     # ~ test_plane()
     test_triangle()
+    # ~ test_mesh()
+    # ~ test_sphere_set()
     return 0
 
 if __name__ == '__main__':
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  wavefront.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Render por etapas (wavefront): en lugar de seguir cada pixel hasta el
+    final (rayo primario, sombras, siguiente pixel), cada etapa procesa
+    todos los rayos a la vez, con los kernels vectorizados sobre los
+    buffers de la escena (ver buffers.py):
+
+        primary     Genera todos los rayos primarios y los intersecta
+        shade       Luz ambiente de los impactos, normales
+        shadow      Una cola de rayos de sombra por fuente de luz; se
+                    intersecta y se suma la luz difusa donde llega
+
+    Todos los rayos de una cola salen del mismo punto (la cámara o la
+    fuente de luz). Se ordenan por dirección (código de Morton sobre el
+    mapa octaédrico de la esfera) y se procesan en paquetes: cada paquete
+    es un cono, y solo se intersecta con las primitivas cuya esfera
+    envolvente cae en el cono. Los paquetes con muchas primitivas se
+    dividen en conos más angostos, descartando en cada nivel.
+
+    El resultado es el mismo que el de Scene.trace_ray: mismas normales
+    (Triangle sin normalizar, Mesh hacia el rayo) y los planos no se
+    intersectan, como en Plane.intersection.
+"""
+
+from contextlib import nullcontext
+
+import numpy as np
+
+from rtmath import epsilon
+from framebuffer import Framebuffer
+from things import spheres_intersect, triangles_intersect
+from buffers import KIND_SPHERE, KIND_TRI
+
+# Rayos por paquete. Los paquetes se dividen mientras tengan más de
+# WAVEFRONT_LEAF rayos y más de WAVEFRONT_LEAF_TESTS pruebas rayo/primitiva
+WAVEFRONT_PACKET = 4096
+WAVEFRONT_LEAF = 16
+WAVEFRONT_LEAF_TESTS = 8192
+
+# Bits por coordenada del código de Morton de las direcciones
+MORTON_BITS = 10
+
+
+def nullstage(name):
+    return nullcontext()
+
+
+def direction_order(dirs):
+    """ Orden de los rayos (dirs (N, 3), unitarios) que agrupa direcciones
+        cercanas: código de Morton de la proyección octaédrica
+    """
+    l1 = np.abs(dirs).sum(axis = 1)
+    u = dirs[:, 0] / l1
+    v = dirs[:, 1] / l1
+    lower = dirs[:, 2] < 0              # Hemisferio inferior: se "dobla"
+    u, v = (np.where(lower, (1 - np.abs(v)) * np.sign(u), u),
+            np.where(lower, (1 - np.abs(u)) * np.sign(v), v))
+
+    scale = (1 << MORTON_BITS) - 1
+    qu = np.clip((u + 1) / 2 * scale, 0, scale).astype(np.uint32)
+    qv = np.clip((v + 1) / 2 * scale, 0, scale).astype(np.uint32)
+    return np.argsort(spread_bits(qu) | (spread_bits(qv) << 1), kind = "stable")
+
+
+def spread_bits(x):
+    """ Intercala un 0 entre los bits de x (enteros de hasta 16 bits)
+    """
+    x = x.astype(np.uint32)
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+
+
+class WavefrontTracer:
+    def __init__(self, scene):
+        """ scene       Escena clasificada. Se compila (Scene.compile) si
+                        no se hizo antes.
+        """
+        self.scene = scene
+        scene.compile()                 # No hace nada si ya está compilada
+        b = self.buffers = scene.buffers
+
+        # Esferas envolventes de las primitivas, para descartar las que
+        # están fuera del cono de cada paquete
+        self.sphere_bounds = (b.sphere_centers, b.sphere_radii)
+        corners = (b.tri_v0, b.tri_v0 + b.tri_e1, b.tri_v0 + b.tri_e2)
+        center = (corners[0] + corners[1] + corners[2]) / 3
+        radius = np.max([np.linalg.norm(c - center, axis = 1) for c in corners],
+                        axis = 0) if len(center) else np.zeros(0)
+        self.tri_bounds = (center, radius)
+
+
+    def candidates(self, bounds, idx, origin, dirs, tmax):
+        """ Las primitivas de idx (índices en bounds: centros, radios) que
+            pueden cortar a alguno de los rayos (origin común, dirs (n, 3),
+            hasta tmax (n,))
+        """
+        if len(idx) == 0:
+            return idx
+        centers, radii = bounds[0][idx], bounds[1][idx]
+
+        axis = dirs.sum(axis = 0)
+        length = np.sqrt(axis @ axis)
+        rel = centers - origin
+        dist = np.sqrt(np.einsum("ij,ij->i", rel, rel))
+        keep = dist - radii < tmax.max()
+        if length < epsilon:            # Direcciones opuestas: sin cono
+            return idx[keep]
+
+        axis /= length
+        cone = np.arccos(np.clip((dirs @ axis).min(), -1, 1))
+        inside = dist <= radii
+        safe = np.where(inside, 1, dist)
+        theta = np.arccos(np.clip((rel @ axis) / safe, -1, 1))
+        half = np.arcsin(np.clip(radii / safe, 0, 1))
+        keep &= inside | (theta <= cone + half + epsilon)
+        return idx[keep]
+
+
+    def intersect_packet(self, origin, dirs, tmax, spheres, tris):
+        """ Impacto más cercano (t > 0) de un paquete de rayos con origen
+            común, entre las primitivas spheres, tris (índices). Si hay
+            muchas pruebas, se divide el paquete en dos (las direcciones
+            están ordenadas: cada mitad es un cono más angosto).
+            Devuelve (t, kind, prim), ver SceneBuffers.intersect.
+        """
+        spheres = self.candidates(self.sphere_bounds, spheres, origin, dirs, tmax)
+        tris = self.candidates(self.tri_bounds, tris, origin, dirs, tmax)
+        n = len(dirs)
+        if n > WAVEFRONT_LEAF and (len(spheres) + len(tris)) * n > WAVEFRONT_LEAF_TESTS:
+            half = n // 2
+            first = self.intersect_packet(origin, dirs[:half], tmax[:half], spheres, tris)
+            second = self.intersect_packet(origin, dirs[half:], tmax[half:], spheres, tris)
+            return tuple(np.concatenate(pair) for pair in zip(first, second))
+
+        b = self.buffers
+        origins = np.broadcast_to(origin, dirs.shape)
+        t, prim = spheres_intersect(origins, dirs, b.sphere_centers[spheres],
+                                    b.sphere_radii[spheres])
+        hit = prim >= 0
+        prim[hit] = spheres[prim[hit]]
+        kind = np.where(hit, KIND_SPHERE, -1)
+
+        tt, _, _, tprim = triangles_intersect(origins, dirs, b.tri_v0[tris],
+                                              b.tri_e1[tris], b.tri_e2[tris])
+        closer = tt < t
+        t[closer] = tt[closer]
+        kind[closer] = KIND_TRI
+        prim[closer] = tris[tprim[closer]]
+        return t, kind, prim
+
+
+    def intersect_queue(self, origin, dirs, tmax = None, progress = None):
+        """ Intersecta una cola de rayos (origin común, dirs (N, 3)),
+            ordenada por dirección y en paquetes. tmax (N,), opcional,
+            acota la búsqueda (rayos de sombra). progress (opcional) se
+            llama después de cada paquete.
+            Devuelve (t, kind, prim), en el orden de dirs.
+        """
+        n = len(dirs)
+        if tmax is None:
+            tmax = np.full(n, np.inf)
+        t = np.full(n, np.inf)
+        kind = np.full(n, -1)
+        prim = np.full(n, -1, dtype = np.intp)
+
+        spheres = np.arange(len(self.sphere_bounds[1]))
+        tris = np.arange(len(self.tri_bounds[1]))
+        order = direction_order(dirs)
+        for first in range(0, n, WAVEFRONT_PACKET):
+            rays = order[first:first + WAVEFRONT_PACKET]
+            t[rays], kind[rays], prim[rays] = self.intersect_packet(
+                                origin, dirs[rays], tmax[rays], spheres, tris)
+            if progress is not None:
+                progress()
+        return t, kind, prim
+
+
+    def normals(self, kind, prim, points, dirs):
+        """ Normales en los impactos (points (N, 3)), como las de los
+            objetos (Sphere.intersection, Triangle.intersection,
+            Mesh.intersection)
+        """
+        b = self.buffers
+        normals = np.empty_like(points)
+
+        sph = kind == KIND_SPHERE
+        rel = points[sph] - b.sphere_centers[prim[sph]]
+        normals[sph] = rel / np.sqrt(np.einsum("ij,ij->i", rel, rel))[:, np.newaxis]
+
+        tri = kind == KIND_TRI
+        n = b.tri_normals[prim[tri]]
+        facing = (np.einsum("ij,ij->i", n, dirs[tri]) > 0) & b.tri_two_sided[prim[tri]]
+        n[facing] *= -1
+        normals[tri] = n
+        return normals
+
+
+    def material(self, kind, prim):
+        """ Colores (N, 3) de las primitivas impactadas
+        """
+        b = self.buffers
+        mat = np.empty(len(kind), dtype = np.intp)
+        sph, tri = kind == KIND_SPHERE, kind == KIND_TRI
+        mat[sph] = b.sphere_material[prim[sph]]
+        mat[tri] = b.tri_material[prim[tri]]
+        return b.materials[mat]
+
+
+    def render(self, width, height, ambient, stage = nullstage,
+               progress = None, fb = None):
+        """ Renderiza la imagen en fb, o en un Framebuffer nuevo, y lo
+            devuelve.
+            stage       Función que devuelve un context manager por etapa
+                        (p.ej. RenderStats.stage), para medir tiempos
+            progress    Función (opcional) llamada entre etapas y entre
+                        paquetes de rayos (p.ej. para procesar los eventos
+                        de la interfaz)
+        """
+        cam = self.scene.cam
+        with stage("primary"):
+            origins, dirs, _, _ = cam.ray_arrays(width, height)
+            eye = origins[0]
+            t, kind, prim = self.intersect_queue(eye, dirs, progress = progress)
+
+        with stage("shade"):
+            hit = np.flatnonzero(kind >= 0)
+            self.hits = len(hit)
+            kind, prim, t, dirs = kind[hit], prim[hit], t[hit], dirs[hit]
+            points = eye + dirs * t[:, np.newaxis]
+            normals = self.normals(kind, prim, points, dirs)
+            color = self.material(kind, prim)
+            pixels = color * ambient
+        if progress is not None:
+            progress()
+
+        with stage("shadow"):
+            for light in self.scene.els["lights"]:
+                loc = np.array(light.location.to_tuple())
+                light_color = np.array((light.color.r, light.color.g, light.color.b))
+
+                incident = points - loc
+                dist = np.sqrt(np.einsum("ij,ij->i", incident, incident))
+                incident /= dist[:, np.newaxis]
+                tmax = dist - epsilon
+                ts, _, _ = self.intersect_queue(loc, incident, tmax, progress)
+
+                lit = ts >= tmax
+                cos_ang = -np.einsum("ij,ij->i", normals[lit], incident[lit])
+                pixels[lit] += (color[lit] * light_color) * cos_ang[:, np.newaxis]
+
+        with stage("output"):
+            image = np.zeros((width * height, 3))
+            image[hit] = pixels
+            if fb is None:
+                fb = Framebuffer(width, height)
+            # La imagen tiene el eje y invertido respecto a la cámara
+            fb.set_block(0, 0, image.reshape(height, width, 3)[::-1])
+        return fb
+
+
+
+def test_direction_order():
+    rng = np.random.default_rng(0)
+    dirs = rng.normal(size = (8, 3))
+    dirs /= np.linalg.norm(dirs, axis = 1, keepdims = True)
+    print(dirs[direction_order(dirs)])
+
+
+def test_wavefront(name = "demo1", width = 160, height = 120):
+    import time
+    from bench import scene_text
+    from render import load_scene, DEFAULT_AMBIENT
+
+    scene = load_scene(scene_text(name))
+    scene.render(width, height, DEFAULT_AMBIENT)
+    scalar = scene.cam.fb.to_uint8()
+
+    t0 = time.perf_counter()
+    scene.render(width, height, DEFAULT_AMBIENT, wavefront = True)
+    print("{}: {:.3f} s, {} pixeles distintos".format(
+                name, time.perf_counter() - t0,
+                int((scene.cam.fb.to_uint8() != scalar).any(axis = -1).sum())))
+
+
+def main(args):
+    # ~ test_direction_order()
+    test_wavefront()
+    # ~ test_wavefront("spheres-1000")
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))